@@ -1,51 +1,844 @@
 #!/usr/bin/env python
 from __future__ import print_function
-import sys, random, string, struct
+import sys, os, random, string, struct, multiprocessing, binascii, time, \
+        ctypes, hmac, collections, json, contextlib, platform, socket, threading
 from hashlib import sha256
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if sys.version[0] == '2':
+    range = xrange
+
+# nonces a worker checks between looking at whether someone else already won
+CHUNK = 1 << 14
+NOT_FOUND = 2**64 - 1
+# seconds between progress reports / checkpoints
+PROGRESS_INTERVAL = 5
+CHECKPOINT_INTERVAL = 10
+pack_nonce = struct.Struct('<Q').pack
+# nonces per sha256_batch call, larger blocks no longer fit the caches
+BATCH = 1 << 14
+
+SHA256_IV = (
+    0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a,
+    0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19)
+SHA256_K = (
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1,
+    0x923f82a4, 0xab1c5ed5, 0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3,
+    0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174, 0xe49b69c1, 0xefbe4786,
+    0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147,
+    0x06ca6351, 0x14292967, 0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13,
+    0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85, 0xa2bfe8a1, 0xa81a664b,
+    0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a,
+    0x5b9cca4f, 0x682e6ff3, 0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208,
+    0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2)
+
 def proof_of_work_okay(chall, solution, hardness):
     h = sha256(chall.encode('ASCII') + struct.pack('<Q', solution)).hexdigest()
     return int(h, 16) < 2**256 / hardness
 
+def digest_threshold(hardness):
+    '''
+    Returns the smallest raw sha256 digest that fails proof_of_work_okay, or
+    None if every digest passes. Comparing digests against this is exactly
+    equivalent to the int(h, 16) < 2**256 / hardness check (including the
+    float division on Python 3 and the floor division on Python 2).
+    '''
+    limit = 2**256 / hardness
+    t = int(limit)
+    if t < limit:
+        t += 1
+    if t >= 2**256:
+        return None
+    return binascii.unhexlify('%064x' % t)
+
+def search_range(task, hardness, start, stop):
+    '''
+    Returns the first nonce in [start, stop) solving the task, or None.
+
+    The challenge prefix is hashed once and the state copied for every nonce,
+    and digests are compared raw against digest_threshold(hardness) instead of
+    going through hexdigest() and int().
+    '''
+    threshold = digest_threshold(hardness)
+    if threshold is None:
+        return start if start < stop else None
+    prefix = sha256(task.encode('ASCII'))
+    for i in range(start, stop):
+        h = prefix.copy()
+        h.update(pack_nonce(i))
+        if h.digest() < threshold:
+            return i
+    return None
+
+def _rotr(x, n):
+    return (x >> numpy.uint32(n)) | (x << numpy.uint32(32 - n))
+
+def _sha256_compress(state, w):
+    '''
+    One SHA-256 block over arrays of uint32 words. Words that are the same
+    for every lane are passed as 1-element arrays and broadcast, so blocks
+    that do not contain the nonce are effectively computed once (the midstate).
+    '''
+    w = list(w)
+    for t in range(16, 64):
+        s0 = _rotr(w[t-15], 7) ^ _rotr(w[t-15], 18) ^ (w[t-15] >> numpy.uint32(3))
+        s1 = _rotr(w[t-2], 17) ^ _rotr(w[t-2], 19) ^ (w[t-2] >> numpy.uint32(10))
+        w.append(w[t-16] + s0 + w[t-7] + s1)
+    a, b, c, d, e, f, g, h = state
+    for t in range(64):
+        t1 = (h + (_rotr(e, 6) ^ _rotr(e, 11) ^ _rotr(e, 25))
+                + ((e & f) ^ (~e & g)) + numpy.uint32(SHA256_K[t]) + w[t])
+        t2 = ((_rotr(a, 2) ^ _rotr(a, 13) ^ _rotr(a, 22))
+                + ((a & b) ^ (a & c) ^ (b & c)))
+        h, g, f, e, d, c, b, a = g, f, e, d + t1, c, b, a, t1 + t2
+    return [x + y for x, y in zip(state, (a, b, c, d, e, f, g, h))]
+
+def sha256_batch(prefix, nonces):
+    '''
+    Computes sha256(prefix + pack('<Q', nonce)) for a numpy uint64 array of
+    nonces. Returns the digest as a list of 8 uint32 arrays (big endian words).
+    '''
+    length = len(prefix) + 8
+    padded = bytearray(prefix) + bytearray(8) + bytearray(b'\x80')
+    padded += bytearray((55 - length) % 64) + bytearray(struct.pack('>Q', 8*length))
+
+    nonce_bytes = [((nonces >> numpy.uint64(8*k)) & numpy.uint64(0xff))
+                    .astype(numpy.uint32) for k in range(8)]
+    words = []
+    for j in range(len(padded) // 4):
+        const = struct.unpack('>I', bytes(padded[4*j:4*j+4]))[0]
+        word = numpy.array([const], dtype=numpy.uint32)
+        for pos in range(4*j, 4*j+4):
+            k = pos - len(prefix)
+            if 0 <= k < 8:
+                word = word | (nonce_bytes[k] << numpy.uint32(8*(3 - pos % 4)))
+        words.append(word)
+
+    state = [numpy.array([x], dtype=numpy.uint32) for x in SHA256_IV]
+    for blk in range(0, len(words), 16):
+        state = _sha256_compress(state, words[blk:blk+16])
+    return state
+
+def batch_matches(task, hardness, nonces):
+    '''
+    Returns the indices of all nonces in `nonces` solving the task, in order.
+    All nonces are hashed at once with sha256_batch, which amortizes the
+    interpreter overhead over the whole block, but still is no faster than
+    the hashlib loop of search_range (see `compare`). Without numpy this
+    falls back to a per-nonce loop.
+    '''
+    threshold = digest_threshold(hardness)
+    if threshold is None:
+        return list(range(len(nonces)))
+    if numpy is None:
+        prefix = sha256(task.encode('ASCII'))
+        found = []
+        for idx, i in enumerate(nonces):
+            h = prefix.copy()
+            h.update(pack_nonce(i))
+            if h.digest() < threshold:
+                found.append(idx)
+        return found
+
+    digest = sha256_batch(task.encode('ASCII'),
+                          numpy.asarray(nonces, dtype=numpy.uint64))
+    less = numpy.zeros(len(nonces), dtype=bool)
+    equal = numpy.ones(len(nonces), dtype=bool)
+    for word, limit in zip(digest, struct.unpack('>8I', threshold)):
+        limit = numpy.uint32(limit)
+        less |= equal & (word < limit)
+        equal &= word == limit
+    return [int(idx) for idx in numpy.flatnonzero(less)]
+
+def batch_search(task, hardness, nonces):
+    ''' Index of the first nonce in `nonces` solving the task, or None. '''
+    found = batch_matches(task, hardness, nonces)
+    return found[0] if found else None
+
+def challenge_banner(hardness, challenge):
+    ''' The text `ask` mode shows before reading the response. '''
+    return '\n'.join([
+        '',
+        ' ======================================',
+        ' Proof of work code & solver can be found at https://35c3ctf.ccc.ac/uploads/pow.py',
+        ' You may run the following to solve:',
+        '',
+        '    ./pow.py {}_{}'.format(hardness, challenge),
+        ' ======================================',
+        '',
+        'Proof of work challenge: {}_{}'.format(hardness, challenge),
+        'Your response? ',
+        ])
+
 def random_string(length = 10):
     characters = string.ascii_letters + string.digits
     return ''.join(random.choice(characters) for _ in range(length))
 
+def _challenge_mac(secret, hardness, body):
+    msg = '{}_{}'.format(hardness, body).encode('ASCII')
+    return hmac.new(secret, msg, sha256).hexdigest()[:32]
+
+def signed_challenge(secret, hardness, now=None):
+    '''
+    Returns a challenge of the form <time>-<random>-<mac> that any verifier
+    holding `secret` can check without having issued it. The MAC covers the
+    hardness, so clients can't pick an easier one.
+    '''
+    now = int(time.time() if now is None else now)
+    body = '{:x}-{}'.format(now, binascii.hexlify(os.urandom(6)).decode('ASCII'))
+    return '{}-{}'.format(body, _challenge_mac(secret, hardness, body))
+
+class ReplayCache(object):
+    '''
+    Set of solved challenges, each kept until its `expires` time (default:
+    `ttl` seconds after it was added), when the challenge itself is no longer
+    valid. Expired entries are popped off the front of a deque, so all
+    operations are O(1) amortized; an entry that expires before the one in
+    front of it just lives a little longer. When `capacity` live entries are
+    stored, new ones are refused rather than evicting something still
+    replayable.
+    '''
+    def __init__(self, ttl, capacity=1 << 20):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.seen = set()
+        self.expiry = collections.deque()
+
+    def __len__(self):
+        return len(self.seen)
+
+    def __contains__(self, key):
+        return key in self.seen
+
+    def expire(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            self.seen.discard(self.expiry.popleft()[1])
+
+    def add(self, key, now=None, expires=None):
+        ''' Returns False if `key` was already seen or the cache is full. '''
+        now = time.time() if now is None else now
+        self.expire(now)
+        if key in self.seen or len(self.seen) >= self.capacity:
+            return False
+        self.seen.add(key)
+        if expires is None:
+            expires = now + self.ttl
+        self.expiry.append((expires, key))
+        return True
+
+def check_signed_challenge(secret, hardness, challenge, solution, ttl,
+                           cache=None, now=None, skew=5):
+    '''
+    Verifies a solution to a challenge from signed_challenge: the MAC must
+    match, the challenge must be at most `ttl` seconds old, the PoW must be
+    valid and (if a ReplayCache is given) not used before.
+    '''
+    now = time.time() if now is None else now
+    try:
+        stamp, rand, mac = challenge.split('-')
+        issued = int(stamp, 16)
+    except ValueError:
+        return False
+    expected = _challenge_mac(secret, hardness, '{}-{}'.format(stamp, rand))
+    if not hmac.compare_digest(mac, expected):
+        return False
+    if not -skew <= now - issued <= ttl:
+        return False
+    if not 0 <= solution < 2**64 or not proof_of_work_okay(challenge, solution, hardness):
+        return False
+    # the challenge is accepted up to issued + ttl, issued may be `skew` ahead
+    return cache is None or cache.add(challenge, now, issued + ttl + skew)
+
+def check_response(hardness, challenge, response, secret=None, ttl=300,
+                   cache=None, now=None):
+    '''
+    Checks a client's response line to `challenge`. That is either a nonce
+    for it, or (with a secret) `[HARDNESS_]CHALLENGE NONCE` for any signed
+    challenge that is still valid, e.g. one from `./pow.py issue` or another
+    front-end, solved ahead of time. A given hardness must be at least
+    `hardness`. Malformed responses are rejected.
+    '''
+    try:
+        parts = response.split()
+        if len(parts) == 2 and secret is not None:
+            challenge, sol = parts
+            if '_' in challenge:
+                given, challenge = challenge.split('_', 1)
+                if int(given) < hardness:
+                    return False
+                hardness = int(given)
+        elif len(parts) == 1:
+            sol, = parts
+        else:
+            return False
+        sol = int(sol)
+    except ValueError:
+        return False
+    if secret is None:
+        return 0 <= sol < 2**64 and proof_of_work_okay(challenge, sol, hardness)
+    return check_signed_challenge(secret, hardness, challenge, sol, ttl,
+                                  cache, now)
+
+class HardnessController(object):
+    '''
+    Raises the hardness while a service is overloaded and lowers it again once
+    load drops, staying within [minimum, maximum].
+
+    Load is the largest of arrival rate / max_rate, in-flight sessions /
+    max_inflight and the backend saturation (0..1) passed to update(). Above
+    `high` the hardness is multiplied by `step`, below `low` divided by it, and
+    in between it stays put. Changes are at least `cooldown` seconds apart.
+    '''
+    def __init__(self, minimum, maximum, step=2.0, high=0.8, low=0.4,
+                 max_rate=None, max_inflight=None, cooldown=10, grace=60):
+        if minimum > maximum:
+            raise ValueError('minimum hardness above the maximum')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.high = high
+        self.low = low
+        self.max_rate = max_rate
+        self.max_inflight = max_inflight
+        self.cooldown = cooldown
+        self.grace = grace
+
+        self.value = self.previous = minimum
+        self.changed = None
+        self.inflight = 0
+        self.arrivals = 0
+        self.rate = 0.0
+        self.last_update = None
+
+    def set_minimum(self, minimum):
+        ''' Changes the lower bound, raising the hardness right away if needed. '''
+        if minimum > self.maximum:
+            raise ValueError('minimum hardness above the maximum')
+        self.minimum = minimum
+        self.value = max(self.value, minimum)
+        self.previous = max(self.previous, minimum)
+
+    def arrival(self):
+        self.arrivals += 1
+
+    def started(self):
+        self.inflight += 1
+
+    def finished(self):
+        self.inflight -= 1
+
+    def load(self, saturation=0.0):
+        load = saturation
+        if self.max_rate:
+            load = max(load, self.rate / self.max_rate)
+        if self.max_inflight:
+            load = max(load, float(self.inflight) / self.max_inflight)
+        return load
+
+    def update(self, saturation=0.0, inflight=None, now=None):
+        ''' Call periodically. Returns the (possibly changed) hardness. '''
+        now = time.time() if now is None else now
+        if inflight is not None:
+            self.inflight = inflight
+        if self.last_update is not None and now > self.last_update:
+            self.rate = self.arrivals / (now - self.last_update)
+        self.arrivals = 0
+        self.last_update = now
+
+        if self.changed is not None and now - self.changed < self.cooldown:
+            return self.value
+        load = self.load(saturation)
+        value = self.value
+        if load > self.high:
+            value = min(self.value * self.step, self.maximum)
+        elif load < self.low:
+            value = max(self.value / self.step, self.minimum)
+        if value != self.value:
+            self.previous, self.value, self.changed = self.value, value, now
+        return self.value
+
+    def accepted(self, now=None):
+        '''
+        The lowest hardness a solution may have been computed for. Clients
+        that fetched the value just before a raise stay valid for `grace`
+        seconds.
+        '''
+        now = time.time() if now is None else now
+        if self.changed is not None and now - self.changed < self.grace:
+            return min(self.value, self.previous)
+        return self.value
+
 def solve_proof_of_work(task):
     hardness, task = task.split('_')
     hardness = int(hardness)
 
     ''' You can use this to solve the proof of work. '''
     print('Creating proof of work for {} (hardness {})'.format(task, hardness))
+    progress = Progress(hardness)
     i = 0
     while True:
-        if i % 1000000 == 0: print('Progress: %d' % i)
-        if proof_of_work_okay(task, i, hardness):
-            return i
+        sol = search_range(task, hardness, i, i + CHUNK)
+        if sol is not None:
+            return sol
+        i += CHUNK
+        progress.update(i)
+
+class Progress(object):
+    '''
+    Prints the hash rate and expected remaining time at most every `interval`
+    seconds. Each nonce succeeds with probability 1/hardness, so the expected
+    work is `hardness` attempts and, the search being memoryless, the expected
+    time left is always hardness / rate no matter how long we've been going.
+    '''
+    def __init__(self, hardness, done=0, interval=PROGRESS_INTERVAL):
+        self.hardness = hardness
+        self.start_done = done
+        self.start = self.last = time.time()
+        self.interval = interval
+
+    def update(self, done):
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        rate = (done - self.start_done) / (now - self.start)
+        print('Progress: {} ({:.0f}% of expected work), {:.0f} H/s, '
+              'expected {:.0f}s more'.format(
+                  done, 100. * done / self.hardness, rate, self.hardness / rate))
+
+def load_checkpoint(path, task):
+    ''' Returns (searched, solution) for `task` from the state file at `path`. '''
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return 0, None
+    if state.get('task') != task:
+        return 0, None
+    return state['searched'], state.get('solution')
+
+def save_checkpoint(path, task, searched, solution=None):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'task': task, 'searched': searched, 'solution': solution}, f)
+    os.rename(tmp, path)
+
+def solve_proof_of_work_resumable(task, state_file, interval=CHECKPOINT_INTERVAL):
+    '''
+    Like solve_proof_of_work, but records in `state_file` every `interval`
+    seconds that all nonces below some bound have been searched, and
+    continues from there when run again for the same task. The solution is
+    stored too, so a finished task returns immediately.
+    '''
+    searched, sol = load_checkpoint(state_file, task)
+    if sol is not None:
+        return sol
+    hardness, chall = task.split('_')
+    hardness = int(hardness)
+
+    print('Creating proof of work for {} (hardness {}), resuming at {}'.format(
+        chall, hardness, searched))
+    progress = Progress(hardness, searched)
+    last_save = time.time()
+    i = searched
+    while True:
+        sol = search_range(chall, hardness, i, i + CHUNK)
+        if sol is not None:
+            save_checkpoint(state_file, task, sol, sol)
+            return sol
+        i += CHUNK
+        progress.update(i)
+        if time.time() - last_save >= interval:
+            save_checkpoint(state_file, task, i)
+            last_save = time.time()
+
+def solve_proof_of_work_batch(task, batch=BATCH):
+    '''
+    Like solve_proof_of_work, but evaluates `batch` nonces at a time with
+    batch_search. Mostly useful for comparing engines, it is not faster.
+    '''
+    hardness, task = task.split('_')
+    hardness = int(hardness)
+
+    print('Creating proof of work for {} (hardness {}, batches of {})'.format(
+        task, hardness, batch))
+    i = 0
+    while True:
+        nonces = range(i, i + batch)
+        if numpy is not None:
+            nonces = numpy.arange(i, i + batch, dtype=numpy.uint64)
+        idx = batch_search(task, hardness, nonces)
+        if idx is not None:
+            return i + idx
+        i += batch
+
+class BackgroundSolver(object):
+    '''
+    Solves `task` with solve_proof_of_work_parallel from a background thread,
+    so the caller can keep reading the banner meanwhile. result() waits for
+    the nonce, or raises what the solver raised.
+    '''
+    def __init__(self, task, workers=None):
+        self.task = task
+        self.workers = workers
+        self.solution = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.solution = solve_proof_of_work_parallel(self.task, self.workers)
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def result(self):
+        # join() without a timeout can't be interrupted on Python 2
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+        if self.error is not None:
+            raise self.error
+        return self.solution
+
+class ChallengeExpired(EOFError):
+    ''' The service has most likely given up on the challenge already. '''
+    pass
+
+class PowConnection(object):
+    '''
+    Connects to a PoW-protected service, reads the challenge and solves it,
+    all in a background thread. Only the bytes up to the end of the challenge
+    line are consumed, the rest of the banner is left for the caller.
+    '''
+    def __init__(self, host, port, prompt=b'challenge: ', workers=None):
+        self.host = host
+        self.port = port
+        self.prompt = prompt
+        self.workers = workers
+        self.sock = None
+        self.solution = None
+        self.error = None
+        # when the challenge was read
+        self.challenged = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_until(self, delim):
+        buf = b''
+        while not buf.endswith(delim):
+            c = self.sock.recv(1)
+            if not c:
+                raise EOFError('connection closed before the PoW challenge')
+            buf += c
+        return buf
+
+    def _run(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._read_until(self.prompt)
+            task = self._read_until(b'\n').strip().decode('ASCII')
+            self.challenged = time.time()
+            self.solution = solve_proof_of_work_parallel(task, self.workers)
+        except Exception as e:
+            self.error = e
+
+    def age(self):
+        ''' Seconds since the challenge was read, 0 before that. '''
+        if self.challenged is None:
+            return 0
+        return time.time() - self.challenged
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+
+    def answer(self, max_age=None):
+        '''
+        Waits for the solution, sends it and returns the socket. Raises
+        ChallengeExpired instead if the challenge was read more than
+        `max_age` seconds ago: the service gives no sign of having timed it
+        out until the answer was sent.
+        '''
+        while self.thread.is_alive():
+            self.thread.join(0.1)
+        if self.error is not None:
+            raise self.error
+        if max_age is not None and self.age() > max_age:
+            raise ChallengeExpired('challenge is %.0fs old' % self.age())
+        self.sock.sendall(('%d\n' % self.solution).encode('ASCII'))
+        return self.sock
+
+class PowPipeline(object):
+    '''
+    Hands out sockets that have passed the PoW. As soon as one is handed out,
+    the next connection is opened and its challenge solved in the background,
+    so a retry usually finds it ready.
+
+    A warm connection whose challenge is older than `max_age` seconds (set it
+    a bit below the service's timeout for answers) or that was closed is
+    dropped, and next() solves a fresh one instead. Without `max_age`, one
+    the service timed out silently is still handed out.
+    '''
+    def __init__(self, host, port, max_age=None, **kw):
+        self.host = host
+        self.port = port
+        self.max_age = max_age
+        self.kw = kw
+        self.warm = None
+
+    def _connect(self):
+        return PowConnection(self.host, self.port, **self.kw)
+
+    def next(self):
+        conn, self.warm = self.warm or self._connect(), None
+        try:
+            sock = conn.answer(self.max_age)
+        except (EOFError, socket.error):
+            conn.close()
+            sock = self._connect().answer()
+        self.warm = self._connect()
+        return sock
+
+def _search_chunks(task, hardness, start, stride, found):
+    while found.value >= start:
+        sol = search_range(task, hardness, start, start + CHUNK)
+        if sol is not None:
+            with found.get_lock():
+                found.value = min(found.value, sol)
+            return
+        start += stride
+
+def solve_proof_of_work_parallel(task, workers=None):
+    '''
+    Like solve_proof_of_work, but splits the nonce space across `workers`
+    processes (default: one per core). Worker k scans chunks k, k+workers, ...
+    and gives up once a nonce below its next chunk has been found, so the
+    result is the same smallest nonce the serial solver returns. Raises
+    RuntimeError if the workers died without finding one.
+    '''
+    hardness, task = task.split('_')
+    hardness = int(hardness)
+    workers = workers or multiprocessing.cpu_count()
+
+    print('Creating proof of work for {} (hardness {}, {} workers)'.format(
+        task, hardness, workers))
+    found = multiprocessing.Value(ctypes.c_uint64, NOT_FOUND)
+    procs = [multiprocessing.Process(target=_search_chunks,
+                args=(task, hardness, k*CHUNK, workers*CHUNK, found))
+             for k in range(workers)]
+    for p in procs:
+        p.daemon = True
+        p.start()
+    try:
+        for p in procs:
+            p.join()
+    finally:
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+    if found.value == NOT_FOUND:
+        # only a worker that died stops without a solution
+        raise RuntimeError('PoW workers failed (exit codes {})'.format(
+            ', '.join(str(p.exitcode) for p in procs)))
+    return found.value
+
+def compare_engines(hardness=1000, nonces=200000):
+    '''
+    Times the original per-nonce proof_of_work_okay loop against
+    search_range and batch_matches on the same nonces and checks that they
+    agree. Every engine looks at each nonce exactly once.
+    '''
+    task = random_string()
+
+    t0 = time.time()
+    naive = [i for i in range(nonces) if proof_of_work_okay(task, i, hardness)]
+    t1 = time.time()
+    fast, i = [], 0
+    while True:
+        i = search_range(task, hardness, i, nonces)
+        if i is None:
+            break
+        fast.append(i)
         i += 1
+    t2 = time.time()
+    batched = []
+    for i in range(0, nonces, BATCH):
+        block = range(i, min(i + BATCH, nonces))
+        if numpy is not None:
+            block = numpy.arange(i, min(i + BATCH, nonces), dtype=numpy.uint64)
+        batched += [i + idx for idx in batch_matches(task, hardness, block)]
+    t3 = time.time()
+
+    assert naive == fast == batched, 'engines disagree on %s' % task
+    print('naive: {:.0f} H/s'.format(nonces / (t1 - t0)))
+    print('fast:  {:.0f} H/s ({:.2f}x)'.format(
+        nonces / (t2 - t1), (t1 - t0) / (t2 - t1)))
+    print('batch: {:.0f} H/s ({:.2f}x{})'.format(
+        nonces / (t3 - t2), (t1 - t0) / (t3 - t2),
+        '' if numpy is not None else ', no numpy'))
+
+STRATEGIES = {
+    'serial': solve_proof_of_work,
+    'batch': solve_proof_of_work_batch,
+    'parallel': solve_proof_of_work_parallel,
+}
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100. * len(values)))]
+
+def benchmark(hardnesses=(1000, 10000, 100000), runs=20, strategies=None,
+              verifications=100000):
+    '''
+    Solves `runs` random challenges per strategy and hardness and times
+    `verifications` calls of each verifier. Hash rates are effective ones:
+    they count the nonces up to and including the solution, not the extra
+    work a batch or the other parallel workers did past it.
+    Returns a JSON-serializable dict.
+    '''
+    result = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': multiprocessing.cpu_count(),
+        'numpy': numpy is not None,
+        'solvers': [],
+        'verifiers': {},
+    }
+
+    for name in strategies or sorted(STRATEGIES):
+        for hardness in hardnesses:
+            times, hashes = [], 0
+            for _ in range(runs):
+                task = '{}_{}'.format(hardness, random_string())
+                t0 = time.time()
+                with quiet():
+                    sol = STRATEGIES[name](task)
+                times.append(time.time() - t0)
+                hashes += sol + 1
+            result['solvers'].append({
+                'strategy': name,
+                'hardness': hardness,
+                'runs': runs,
+                'effective_hashes_per_sec': hashes / sum(times),
+                'mean': sum(times) / runs,
+                'p50': percentile(times, 50),
+                'p90': percentile(times, 90),
+                'p99': percentile(times, 99),
+                'max': max(times),
+            })
+
+    tasks = [random_string() for _ in range(verifications)]
+    t0 = time.time()
+    for i, task in enumerate(tasks):
+        proof_of_work_okay(task, i, 1000)
+    result['verifiers']['plain'] = verifications / (time.time() - t0)
+
+    secret = os.urandom(16)
+    tasks = [signed_challenge(secret, 1) for _ in range(verifications)]
+    cache = ReplayCache(300, capacity=verifications)
+    t0 = time.time()
+    for task in tasks:
+        check_signed_challenge(secret, 1, task, 0, 300, cache)
+    result['verifiers']['signed'] = verifications / (time.time() - t0)
+    return result
+
+def pop_option(name, default=None, type=int):
+    ''' Removes `name VALUE` from sys.argv and returns VALUE. '''
+    if name not in sys.argv:
+        return default
+    i = sys.argv.index(name)
+    value = type(sys.argv[i+1])
+    del sys.argv[i:i+2]
+    return value
 
 if __name__ == '__main__':
     if sys.version[0] == '2':
         input = raw_input
 
-    if len(sys.argv) > 1 and sys.argv[1] == 'ask':
+    # 1 = serial solver, 0 = one worker per core
+    workers = pop_option('--workers', 1)
+    batch = pop_option('--batch')
+    host = pop_option('--host', '0.0.0.0', str)
+    timeout = pop_option('--timeout', 60, float)
+    secret_file = pop_option('--secret_file', type=str)
+    ttl = pop_option('--ttl', 300, float)
+    max_hardness = pop_option('--max_hardness')
+    max_rate = pop_option('--max_rate', type=float)
+    max_inflight = pop_option('--max_inflight')
+    max_sessions = pop_option('--max_sessions')
+    state_file = pop_option('--state', type=str)
+    runs = pop_option('--runs', 20)
+    hardnesses = pop_option('--hardness', '1000,10000,100000', str)
+    strategies = pop_option('--strategies', None, str)
+    output = pop_option('--output', type=str)
+
+    secret = None
+    if secret_file:
+        with open(secret_file, 'rb') as f:
+            secret = f.read().strip()
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        compare_engines(*map(int, sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        result = benchmark(
+            hardnesses=[int(h) for h in hardnesses.split(',')],
+            runs=runs,
+            strategies=strategies and strategies.split(','))
+        result = json.dumps(result, indent=2, sort_keys=True)
+        if output:
+            with open(output, 'w') as f:
+                f.write(result + '\n')
+        print(result)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        # pow_server needs Python 3, keep this file importable on Python 2
+        import pow_server
+        hardness = int(sys.argv[2])
+        controller = None
+        if max_hardness:
+            controller = HardnessController(hardness, max_hardness,
+                    max_rate=max_rate, max_inflight=max_inflight)
+        pow_server.serve(hardness, int(sys.argv[3]), sys.argv[4],
+                         host=host, timeout=timeout, secret=secret, ttl=ttl,
+                         controller=controller, max_sessions=max_sessions)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'issue':
+        # a signed challenge to solve ahead of time, see check_response
+        if secret is None:
+            sys.exit('issue needs --secret_file')
+        hardness = int(sys.argv[2])
+        print('{}_{}'.format(hardness, signed_challenge(secret, hardness)))
+    elif len(sys.argv) > 1 and sys.argv[1] == 'ask':
         hardness = int(sys.argv[2])
 
-        challenge = random_string()
-        print()
-        print(' ======================================')
-        print(' Proof of work code & solver can be found at https://35c3ctf.ccc.ac/uploads/pow.py')
-        print(' You may run the following to solve:')
-        print()
-        print('    ./pow.py {}_{}'.format(hardness, challenge))
-        print(' ======================================')
-        print()
-
-        print('Proof of work challenge: {}_{}'.format(hardness, challenge))
-        sys.stdout.write('Your response? ')
+        # one process per connection, so replays are only caught by `serve`
+        if secret is None:
+            challenge = random_string()
+        else:
+            challenge = signed_challenge(secret, hardness)
+        sys.stdout.write(challenge_banner(hardness, challenge))
         sys.stdout.flush()
-        sol = int(input())
-        if not proof_of_work_okay(challenge, sol, hardness):
+        if not check_response(hardness, challenge, input(), secret, ttl):
             print('Wrong :(')
             exit(1)
     else:
@@ -55,4 +848,12 @@ if __name__ == '__main__':
             sys.stdout.write('Challenge? ')
             sys.stdout.flush()
             challenge = input()
-        print('Solution: {}'.format(solve_proof_of_work(challenge)))
+        if state_file:
+            sol = solve_proof_of_work_resumable(challenge, state_file)
+        elif batch:
+            sol = solve_proof_of_work_batch(challenge, batch)
+        elif workers == 1:
+            sol = solve_proof_of_work(challenge)
+        else:
+            sol = solve_proof_of_work_parallel(challenge, workers)
+        print('Solution: {}'.format(sol))
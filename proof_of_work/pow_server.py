@@ -0,0 +1,152 @@
+'''
+Asyncio front-end for pow.py: one process issues and checks challenges for
+all incoming connections and splices solved ones through to a backend.
+
+    ./pow.py serve HARDNESS PORT tcp:127.0.0.1:1338 [--host H] [--timeout T]
+    ./pow.py serve HARDNESS PORT 'exec:/chall/run.sh' [--host H] [--timeout T]
+
+With --secret_file, challenges are HMAC-signed and timestamped (see
+pow.signed_challenge), so every front-end sharing the key accepts them for
+--ttl seconds; solved ones go into a per-process ReplayCache. Clients may
+also answer with `[HARDNESS_]CHALLENGE NONCE` for any signed challenge that is
+still valid, e.g. one from `./pow.py issue` solved ahead of time, instead of
+the one they were just shown (see pow.check_response).
+
+With --max_hardness, a pow.HardnessController moves the hardness between
+HARDNESS and that bound based on the connection rate (--max_rate), pending
+challenges (--max_inflight) and spliced sessions (--max_sessions).
+'''
+import asyncio, shlex
+
+from pow import (random_string, challenge_banner, signed_challenge,
+        check_response, ReplayCache)
+
+BUFSIZE = 1 << 16
+UPDATE_INTERVAL = 2
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(BUFSIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def open_backend(backend):
+    ''' Returns (reader, writer, process) for a tcp:HOST:PORT or exec:CMD spec. '''
+    kind, _, target = backend.partition(':')
+    if kind == 'tcp':
+        host, port = target.rsplit(':', 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+        return reader, writer, None
+    if kind == 'exec':
+        proc = await asyncio.create_subprocess_exec(
+                *shlex.split(target),
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+        return proc.stdout, proc.stdin, proc
+    raise ValueError('backend must be tcp:HOST:PORT or exec:COMMAND')
+
+class Verifier(object):
+    '''
+    Issues and checks challenges, signed ones if a secret is given. The
+    hardness comes from the controller if there is one.
+    '''
+    def __init__(self, hardness, secret=None, ttl=300, controller=None):
+        self.hardness = hardness
+        self.secret = secret
+        self.ttl = ttl
+        self.replays = ReplayCache(ttl)
+        self.controller = controller
+        self.sessions = 0
+
+    def current_hardness(self):
+        if self.controller is None:
+            return self.hardness
+        return int(self.controller.value)
+
+    def issue(self, hardness):
+        if self.secret is None:
+            return random_string()
+        return signed_challenge(self.secret, hardness)
+
+    def check(self, hardness, challenge, response):
+        return check_response(hardness, challenge, response, self.secret,
+                              self.ttl, self.replays)
+
+async def check_client(reader, writer, verifier, timeout):
+    hardness = verifier.current_hardness()
+    challenge = verifier.issue(hardness)
+    writer.write(challenge_banner(hardness, challenge).encode('ASCII'))
+    await writer.drain()
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        line = line.decode('ASCII')
+    except (asyncio.TimeoutError, ValueError):
+        return False
+    return verifier.check(hardness, challenge, line)
+
+async def handle(reader, writer, verifier, backend, timeout):
+    proc = None
+    controller = verifier.controller
+    spliced = False
+    if controller is not None:
+        controller.arrival()
+        controller.started()
+    try:
+        try:
+            ok = await check_client(reader, writer, verifier, timeout)
+        finally:
+            if controller is not None:
+                controller.finished()
+        if not ok:
+            writer.write(b'Wrong :(\n')
+            await writer.drain()
+            return
+        verifier.sessions += 1
+        spliced = True
+        breader, bwriter, proc = await open_backend(backend)
+        await asyncio.gather(pipe(reader, bwriter), pipe(breader, writer))
+    except ConnectionError:
+        pass
+    finally:
+        if spliced:
+            verifier.sessions -= 1
+        writer.close()
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+async def adjust_hardness(verifier, max_sessions):
+    controller = verifier.controller
+    while True:
+        await asyncio.sleep(UPDATE_INTERVAL)
+        saturation = 0.0
+        if max_sessions:
+            saturation = float(verifier.sessions) / max_sessions
+        old = controller.value
+        if controller.update(saturation) != old:
+            print('Hardness %d -> %d (load %.2f)' % (
+                old, controller.value, controller.load(saturation)))
+
+def serve(hardness, port, backend, host='0.0.0.0', timeout=60, secret=None,
+          ttl=300, controller=None, max_sessions=None):
+    verifier = Verifier(hardness, secret, ttl, controller)
+
+    async def main():
+        server = await asyncio.start_server(
+                lambda r, w: handle(r, w, verifier, backend, timeout),
+                host, port, backlog=4096)
+        print('PoW front-end on %s:%d (hardness %d) -> %s' % (
+            host, port, hardness, backend))
+        if controller is not None:
+            asyncio.ensure_future(adjust_hardness(verifier, max_sessions))
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
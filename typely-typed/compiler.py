@@ -2,12 +2,33 @@
 # -*- coding: utf-8 -*-
 from pyparsing import (Literal, Word, Group, ZeroOrMore, Forward,
         alphas, alphanums, Regex, Suppress)
-import os, tempfile, re
-from subprocess import Popen, PIPE
+import os, signal, tempfile, re, threading, queue, select, shutil, time, \
+        atexit, binascii, hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 HSK_TEMPLATE = ROOT + '/EvmCompiler.hs'
 
+GENERATED_RE = re.compile(
+        r'(-- <GENERATED CODE>)(?:.|\n)*(-- </GENERATED CODE>)')
+# the main signature and equation, plus its indented where clause
+MAIN_RE = re.compile(r'^main ∷.*\n^main\b.*\n?(?:(?:[ \t].*)?\n)*', re.M)
+# how GHC (8.0 and later) starts a compile error on stderr
+GHC_ERROR_RE = re.compile(br'^.*\.hs:\d+:\d+: error:', re.M)
+
+# warm ghci sessions, see GhciWorker
+GHCI_START_TIMEOUT = 120
+GHCI_MAX_JOBS = 100
+
+# compile results, see CompileCache
+CACHE_DIR = ROOT + '/hsk_cache'
+CACHE_MEMORY_ENTRIES = 1024
+CACHE_DISK_BYTES = 64 << 20
+# bump when a change to the compilation invalidates old results
+CACHE_VERSION = 1
+
 class Parser():
     def __init__(self):
         number = Regex(r'\d+')
@@ -99,6 +120,13 @@ class Parser():
 class HskTypeError(Exception):
     pass
 
+class HskCrash(Exception):
+    ''' The compiler died without a verdict on the program. '''
+    pass
+
+class CompilerBusy(Exception):
+    pass
+
 def script_to_hsk(code):
     p = Parser()
     try:
@@ -107,27 +135,404 @@ def script_to_hsk(code):
         raise SyntaxError()
     p.finalize()
     builder = '\n  ' + '\n  '.join(p.get())
-    with open(HSK_TEMPLATE, encoding='utf-8') as f:
-        hsk = f.read()
-    hsk = re.sub(
-            r'(-- <GENERATED CODE>)(?:.|\n)*(-- </GENERATED CODE>)',
+    hsk = GENERATED_RE.sub(
             lambda m: '%s\ncode = (%s)\n%s' % (m.group(1), builder, m.group(2)),
-            hsk)
+            template_hsk())
     return hsk
 
+def template_hsk():
+    with open(HSK_TEMPLATE, encoding='utf-8') as f:
+        return f.read()
+
+def split_hsk(hsk):
+    '''
+    Splits a program built from the template into (library, generated, main):
+    the generated `code` block, the `main` that uses it, and the rest with a
+    dummy main. The library is the same for every script.
+    '''
+    gen = GENERATED_RE.search(hsk)
+    main = MAIN_RE.search(hsk)
+    if not gen or not main or gen.end() > main.start():
+        raise ValueError('unexpected template layout')
+    library = (hsk[:gen.start()] + hsk[gen.end():main.start()]
+               + 'main ∷ IO ()\nmain = return ()\n' + hsk[main.end():])
+    return library, hsk[gen.end(1):gen.start(2)], main.group(0)
+
+def language_extensions(hsk):
+    pragmas = re.findall(r'\{-#\s*LANGUAGE\b(.*?)#-\}', hsk, re.S)
+    text = re.sub(r'--.*', '', ','.join(pragmas))
+    return [ext.strip() for ext in text.split(',') if ext.strip()]
+
 def run_hsk(hsk, timeout):
     with tempfile.NamedTemporaryFile(suffix='.hs') as f:
         f.write(hsk.encode('utf-8'))
         f.flush()
         proc = Popen(['runhaskell', f.name, 'compile'],
-                    stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        evmcode, err = proc.communicate(timeout=timeout)
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                    preexec_fn=os.setsid)
+        try:
+            evmcode, err = proc.communicate(timeout=timeout)
+        except TimeoutExpired:
+            # runhaskell leaves ghc processes behind, kill the whole group
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.communicate()
+            raise
+        if proc.returncode == 1 and GHC_ERROR_RE.search(err):
+            raise HskTypeError()
         if proc.returncode != 0:
+            # killed by a signal, out of heap (251), stack overflow (2), ...:
+            # no verdict on the program
+            raise HskCrash('runhaskell exited with %d: %s' % (
+                proc.returncode, err.decode('utf-8', 'replace')[-200:].strip()))
+        return evmcode
+
+class GhciError(Exception):
+    pass
+
+class GhciWorker(object):
+    '''
+    A long-lived ghci session with the library part of the template loaded
+    (see split_hsk). run() enters a script's `code` block together with a
+    copy of main renamed to main_<tag> as one declaration group, so it is
+    type-checked like the top level of the template. Then it runs main_<tag>
+    between BEGIN/END markers.
+
+    If the block does not type-check, main_<tag> does not exist and the
+    output between the markers is empty. On a timeout or crash (HskCrash),
+    or after `max_jobs` scripts, the session is killed and restarted on next
+    use.
+    '''
+    def __init__(self, library, max_jobs=GHCI_MAX_JOBS):
+        self.library = library
+        self.max_jobs = max_jobs
+        self.proc = None
+        self.dir = None
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix='ghci')
+        path = os.path.join(self.dir, 'EvmLibrary.hs')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.library)
+        try:
+            self.proc = Popen(['ghc', '--interactive', '-v0', '-ignore-dot-ghci'],
+                        stdin=PIPE, stdout=PIPE, stderr=DEVNULL, cwd=self.dir,
+                        env=dict(os.environ, LC_ALL='C.UTF-8'),
+                        preexec_fn=os.setsid)
+        except OSError as e:
+            self.stop()
+            raise GhciError(str(e))
+        self.jobs = 0
+        self.buf = b''
+        tag = self._tag()
+        try:
+            self._send('\n'.join([
+                ':set prompt ""',
+                ':set prompt2 ""',
+                ':set prompt-cont ""',
+                ':load *%s' % path,
+                # the interactive defaults differ from those of a module
+                ':set -XMonomorphismRestriction -XNoExtendedDefaultRules',
+                ':set %s' % ' '.join('-X' + ext for ext in
+                                     language_extensions(self.library)),
+                'import System.IO',
+                'hSetBinaryMode stdout True',
+                'putStrLn "READY %s"' % tag,
+                'hFlush stdout',
+                ]))
+            self._read_until(('READY %s\n' % tag).encode(),
+                             time.time() + GHCI_START_TIMEOUT)
+        except (OSError, EOFError, TimeoutExpired) as e:
+            self.stop()
+            raise GhciError('ghci did not start: %r' % e)
+
+    def stop(self):
+        if self.proc is not None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            self.proc.wait()
+            self.proc = None
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
+
+    def _tag(self):
+        return binascii.hexlify(os.urandom(8)).decode('ascii')
+
+    def _send(self, text):
+        self.proc.stdin.write((text + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+
+    def _read_until(self, marker, deadline):
+        ''' Output up to and including marker. '''
+        fd = self.proc.stdout.fileno()
+        while marker not in self.buf:
+            left = deadline - time.time()
+            if left <= 0 or not select.select([fd], [], [], left)[0]:
+                raise TimeoutExpired('ghci', GHCI_START_TIMEOUT)
+            data = os.read(fd, 65536)
+            if not data:
+                raise EOFError('ghci exited')
+            self.buf += data
+        i = self.buf.index(marker) + len(marker)
+        out, self.buf = self.buf[:i], self.buf[i:]
+        return out
+
+    def run(self, generated, main, timeout):
+        if self.proc is None:
+            self.start()
+        tag = self._tag()
+        self.jobs += 1
+        begin = ('BEGIN %s\n' % tag).encode()
+        end = ('\nEND %s\n' % tag).encode()
+        try:
+            self._send('\n'.join([
+                'putStrLn "BEGIN %s"' % tag,
+                ':{',
+                generated.strip('\n'),
+                re.sub(r'^main\b', 'main_' + tag, main, flags=re.M).rstrip(),
+                ':}',
+                'main_' + tag,
+                'putStrLn ""',
+                'putStrLn "END %s"' % tag,
+                'hFlush stdout',
+                ]))
+            out = self._read_until(end, time.time() + timeout)
+        except TimeoutExpired:
+            self.stop()
+            raise TimeoutExpired('ghci', timeout)
+        except (OSError, EOFError) as e:
+            self.stop()
+            raise HskCrash('ghci died: %r' % e)
+        if self.jobs >= self.max_jobs:
+            self.stop()
+        evmcode = out[out.index(begin) + len(begin):-len(end)]
+        if not evmcode:
             raise HskTypeError()
         return evmcode
 
-def compile_script(code, timeout=60):
-    return run_hsk(script_to_hsk(code), timeout)
+class CompileCache(object):
+    '''
+    Compile results by hash of the program: the EVM code, or None for a type
+    error. The program contains the whole template, so a changed template
+    gives new keys. Timeouts and crashes (HskCrash) are not cached.
+
+    The `memory_entries` most recently used results are kept in memory, in
+    front of one file per result in `directory`. The files are evicted
+    least recently used first once they exceed `disk_bytes` together.
+    '''
+    def __init__(self, directory=CACHE_DIR, memory_entries=CACHE_MEMORY_ENTRIES,
+                 disk_bytes=CACHE_DISK_BYTES):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            if len(name) == 64:
+                st = os.stat(os.path.join(directory, name))
+                files.append((st.st_mtime, name, st.st_size))
+        self.disk = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.disk_used = sum(self.disk.values())
+
+    def key(self, hsk):
+        data = ('%d\0%s' % (CACHE_VERSION, hsk)).encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        ''' (True, result) for a cached result, else (False, None). '''
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return True, self.memory[key]
+            if key not in self.disk:
+                return False, None
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+                os.utime(self._path(key))
+            except OSError:
+                self._forget(key)
+                return False, None
+            self.disk.move_to_end(key)
+            result = data[1:] if data[:1] == b'+' else None
+            self._remember(key, result)
+            return True, result
+
+    def put(self, key, result):
+        data = b'!' if result is None else b'+' + result
+        with self.lock:
+            self._remember(key, result)
+            tmp = self._path(key) + '.tmp%d' % threading.get_ident()
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))
+            except OSError:
+                return
+            self._forget(key)
+            self.disk[key] = len(data)
+            self.disk_used += len(data)
+            while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+                old = next(iter(self.disk))
+                try:
+                    os.remove(self._path(old))
+                except OSError:
+                    pass
+                self._forget(old)
+
+    def _remember(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def _forget(self, key):
+        self.disk_used -= self.disk.pop(key, 0)
+
+    def run(self, hsk, timeout, run=None):
+        '''
+        run(hsk, timeout) (default: run_hsk), cached. Only its results and
+        HskTypeError are stored, other exceptions propagate uncached.
+        '''
+        key = self.key(hsk)
+        found, result = self.get(key)
+        if not found:
+            try:
+                result = (run or run_hsk)(hsk, timeout)
+            except HskTypeError:
+                result = None
+            self.put(key, result)
+        if result is None:
+            raise HskTypeError()
+        return result
+
+_default_cache = None
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = CompileCache()
+    return _default_cache
+
+class CompilePool(object):
+    '''
+    Runs run_hsk for at most `workers` jobs at a time, in threads, so the
+    caller (the Tornado IOLoop) is not blocked. Up to `max_queue` further
+    jobs wait for a free worker; beyond that submit() raises CompilerBusy.
+    '''
+    def __init__(self, workers=4, max_queue=32, warm=False,
+                 max_jobs=GHCI_MAX_JOBS, cache=None):
+        self.workers = workers
+        self.cache = cache
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.pending = 0
+        # warm jobs that had to go to runhaskell after all
+        self.fallbacks = 0
+
+        # with `warm`, one GhciWorker per thread, started up front
+        self.warm = warm
+        if warm:
+            self.library = split_hsk(template_hsk())[0]
+            self.idle = queue.Queue()
+            self.ghcis = [GhciWorker(self.library, max_jobs)
+                          for _ in range(workers)]
+            for ghci in self.ghcis:
+                self.idle.put(ghci)
+                self.executor.submit(self._prestart)
+            atexit.register(self.close)
+
+    def _prestart(self):
+        ghci = self.idle.get()
+        try:
+            if ghci.proc is None:
+                ghci.start()
+        except GhciError as e:
+            print('COMPILER: %s' % e)
+        finally:
+            self.idle.put(ghci)
+
+    def _run(self, hsk, timeout):
+        '''
+        run_hsk(hsk, timeout), in a warm ghci if possible. Programs that are
+        not built from the current template, a ghci that cannot be started
+        and one that crashes on the program fall back to runhaskell.
+        '''
+        if not self.warm:
+            return run_hsk(hsk, timeout)
+        try:
+            library, generated, main = split_hsk(hsk)
+        except ValueError:
+            return run_hsk(hsk, timeout)
+        if library != self.library:
+            return run_hsk(hsk, timeout)
+        ghci = self.idle.get()
+        try:
+            return ghci.run(generated, main, timeout)
+        except (GhciError, HskCrash) as e:
+            print('COMPILER: %s, using runhaskell' % e)
+            with self.lock:
+                self.fallbacks += 1
+            return run_hsk(hsk, timeout)
+        finally:
+            self.idle.put(ghci)
+
+    def close(self):
+        if self.warm:
+            for ghci in self.ghcis:
+                ghci.stop()
+
+    def submit(self, hsk, timeout):
+        '''
+        Returns a concurrent.futures.Future for run_hsk(hsk, timeout). The
+        timeout only starts once the job runs. With a CompileCache, cached
+        results are returned right away, without taking a worker.
+        '''
+        if self.cache is not None:
+            found, result = self.cache.get(self.cache.key(hsk))
+            if found:
+                future = Future()
+                if result is None:
+                    future.set_exception(HskTypeError())
+                else:
+                    future.set_result(result)
+                return future
+
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                raise CompilerBusy()
+            self.pending += 1
+        if self.cache is not None:
+            future = self.executor.submit(self.cache.run, hsk, timeout,
+                                          self._run)
+        else:
+            future = self.executor.submit(self._run, hsk, timeout)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def queued(self):
+        ''' Jobs waiting for a worker. '''
+        return max(0, self.pending - self.workers)
+
+def compile_script(code, timeout=60, cache=None):
+    ''' EVM code for a script, through default_cache() unless cache=False. '''
+    hsk = script_to_hsk(code)
+    if cache is False:
+        return run_hsk(hsk, timeout)
+    return (cache or default_cache()).run(hsk, timeout)
 
 
 def test():
@@ -174,21 +579,40 @@ def test():
         '%d+1' % (2**256-1),
     ]
 
+    # script -> EVM code from runhaskell, None for a type error
+    expected = {}
+
     print('======== GOOD ========')
     for scr in good:
         print(scr)
         print()
-        compile_script(scr, timeout=20)
+        expected[scr] = compile_script(scr, timeout=20, cache=False)
 
     print('======== BAD ========')
     for scr in bad:
         print(scr)
         print()
         try:
-            compile_script(scr, timeout=200)
+            compile_script(scr, timeout=200, cache=False)
             assert 0, 'Should have thrown but succeeded'
         except HskTypeError:
-            pass
+            expected[scr] = None
+
+    # the warm sessions type-check differently, they must agree on every verdict
+    print('======== WARM ========')
+    pool = CompilePool(workers=2, warm=True)
+    try:
+        for scr in good + bad:
+            print(scr)
+            print()
+            try:
+                evmcode = pool.submit(script_to_hsk(scr), timeout=200).result()
+            except HskTypeError:
+                evmcode = None
+            assert evmcode == expected[scr], 'ghci disagrees with runhaskell'
+        assert pool.fallbacks == 0, 'ghci was not used for every script'
+    finally:
+        pool.close()
 
 
 if __name__ == '__main__':
@@ -1,2 +1,3 @@
 #!/bin/bash
+cp ../proof_of_work/pow.py .
 docker build -f Dockerfile -t 35c3/typely .
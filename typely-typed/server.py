@@ -14,9 +14,30 @@ import compiler
 ROOT = os.path.dirname(os.path.abspath(__file__))
 TMP_DIR = ROOT + '/tmp/'
 
+sys.path.append(ROOT + '/../proof_of_work')
+from pow import HardnessController
+
+CONTROLLER = None
+COMPILER = None
+
 def load_complexity():
     global COMPLEXITY
-    COMPLEXITY = float(open(ROOT + '/web/complexity.txt').read())
+    complexity = float(open(ROOT + '/web/complexity.txt').read())
+    if CONTROLLER is not None:
+        CONTROLLER.set_minimum(complexity)
+    COMPLEXITY = complexity
+
+def current_complexity():
+    if CONTROLLER is None:
+        return COMPLEXITY
+    return CONTROLLER.value
+
+def update_complexity():
+    old = CONTROLLER.value
+    CONTROLLER.update(saturation=len(queue.active) / MAX_ACTIVE,
+                      inflight=len(queue.todo))
+    if CONTROLLER.value != old:
+        print('COMPLEXITY: %g -> %g' % (old, CONTROLLER.value))
 
 def setup():
     print('Root dir: %s' % ROOT)
@@ -212,6 +233,9 @@ class ReqHandler(tornado.web.RequestHandler):
         hcid = str(hcid)
         assert not '/' in hcid and not '.' in hcid
 
+        if CONTROLLER is not None:
+            CONTROLLER.arrival()
+
         self.pow_cb = cb
 
         url = ('https://hashcash.io/api/checkwork/' + hcid
@@ -226,14 +250,19 @@ class ReqHandler(tornado.web.RequestHandler):
         if response.error:
             return self._powfail()
         work = tornado.escape.json_decode(response.body)
-        if work['totalDone'] < COMPLEXITY or work['verified']:
+        required = COMPLEXITY if CONTROLLER is None else CONTROLLER.accepted()
+        if work['totalDone'] < required or work['verified']:
             return self._powfail()
         self.pow_cb()
 
 
 class UpdateComplexity(tornado.web.RequestHandler):
     def get(self):
-        load_complexity()
+        try:
+            load_complexity()
+        except ValueError as e:
+            self.set_status(400)
+            return self.write('error: %s' % e)
         self.write('ok')
 
 
@@ -291,7 +320,18 @@ class ExecuteHandler(ReqHandler):
 
     def on_good_pow(self, instance, hsk):
         try:
-            evmcode = compiler.run_hsk(hsk, timeout=HSK_TIMEOUT)
+            future = COMPILER.submit(hsk, timeout=HSK_TIMEOUT)
+        except compiler.CompilerBusy:
+            return self.respond_json({
+                'result': 'busy',
+                'help': USAGE,
+                }, status=503)
+        tornado.ioloop.IOLoop.current().add_future(
+            future, functools.partial(self.on_compiled, instance))
+
+    def on_compiled(self, instance, future):
+        try:
+            evmcode = future.result()
         except compiler.HskTypeError:
             return self.respond_json({
                 'result': 'type_error',
@@ -302,6 +342,12 @@ class ExecuteHandler(ReqHandler):
                 'result': 'timeout',
                 'help': USAGE,
                 })
+        except compiler.HskCrash as e:
+            print('COMPILER: %s' % e)
+            return self.respond_json({
+                'result': 'compiler_error',
+                'help': USAGE,
+                }, status=500)
 
         res = instance.conn.run_code(evmcode)
         if res:
@@ -342,7 +388,7 @@ class BankHandler(tornado.web.RequestHandler):
 
 class ConfigHandler(ReqHandler):
     def get(self):
-        return self.respond_json({'complexity': COMPLEXITY})
+        return self.respond_json({'complexity': current_complexity()})
 
 def is_unique_list(lst):
     return len(lst) == len(set(lst))
@@ -439,9 +485,24 @@ if __name__ == '__main__':
     p.add_argument('--nopow', action='store_true')
     p.add_argument('--chain_timeout', type=int, default=3*60)
     p.add_argument('--hsk_timeout', type=int, default=30)
+    p.add_argument('--hsk_workers', type=int, default=4,
+                   help='number of scripts compiled at the same time')
+    p.add_argument('--hsk_queue', type=int, default=32,
+                   help='scripts waiting for compilation before answering busy')
+    p.add_argument('--hsk_warm', action='store_true',
+                   help='compile in long-lived ghci sessions (check them '
+                   'with ./compiler.py TEST against the installed GHC first)')
+    p.add_argument('--hsk_recycle', type=int, default=compiler.GHCI_MAX_JOBS,
+                   help='restart a ghci session after this many scripts')
+    p.add_argument('--hsk_cache', default=compiler.CACHE_DIR,
+                   help='directory for cached compile results ("" to disable)')
+    p.add_argument('--hsk_cache_mb', type=int,
+                   default=compiler.CACHE_DISK_BYTES >> 20)
     p.add_argument('--max_active', type=int, default=100)
     p.add_argument('--host', default='127.0.0.1')
     p.add_argument('--complexity', type=float)
+    p.add_argument('--max_complexity', type=float,
+                   help='let the complexity rise up to this under load')
     p.add_argument('--debug', action='store_true')
     p.add_argument('--port', dest='port', type=int, default=9000)
     args = p.parse_args()
@@ -457,6 +518,17 @@ if __name__ == '__main__':
         COMPLEXITY = args.complexity
 
     queue = Queue()
+    cache = None
+    if args.hsk_cache:
+        cache = compiler.CompileCache(args.hsk_cache,
+                                      disk_bytes=args.hsk_cache_mb << 20)
+    COMPILER = compiler.CompilePool(args.hsk_workers, args.hsk_queue,
+                                    args.hsk_warm, args.hsk_recycle, cache)
+
+    if args.max_complexity is not None:
+        CONTROLLER = HardnessController(COMPLEXITY, args.max_complexity,
+                                        max_inflight=MAX_ACTIVE)
+        tornado.ioloop.PeriodicCallback(update_complexity, 2000).start()
 
     webapp = make_webapp()
     print('Starting on %s:%d' % (args.host, args.port))
@@ -7,9 +7,8 @@ let bank = null;
 let config = null;
 
 async function loadConfig() {
-  if (config === null) {
-    config = await (await fetch(`/config`)).json()
-  }
+  // always refetch, the complexity follows server load
+  config = await (await fetch(`/config`)).json()
 }
 
 async function spawn() {
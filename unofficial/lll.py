@@ -2,14 +2,142 @@
 [1] https://cr.yp.to/bib/2001/nguyen.ps
 [2] https://www.math.cmu.edu/~af1p/Texfiles/RECONTRUNC.pdf
 '''
-from sage.all import (
-    next_prime, matrix, vector, inverse_mod, is_prime,
-    Integers, ZZ, RR
-    )
-from random import randint, randrange, seed
-from IPython import embed
+from random import randint, randrange, seed, Random
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import product
+from multiprocessing import Pool, Process, Queue, cpu_count
+import functools, hashlib, importlib, json, os, resource, sys, time
+try:
+    from queue import Empty
+except ImportError:  # Python 2
+    from Queue import Empty
+
+# Backend for svp, cvp, small_lgs, small_lgs2 and truncated_lgs: 'sage' (this
+# module) or 'fpylll' (lll_fpylll, no Sage needed). None picks sage if it is
+# installed. Overridden by $LLL_BACKEND or per call with backend=...
+BACKEND = None
+BACKENDS = {
+    'sage': None,
+    'fpylll': 'lll_fpylll',
+}
 
 FAST = True
+# run the (algorithm, delta) pairs of lll_params concurrently
+PARALLEL = True
+
+# escalation when LLL isn't good enough, see bkz_reductions()
+BKZ_BLOCK_SIZES = (10, 20, 30, 40, 50)
+BKZ_TIME_BUDGET = 120
+
+# Babai with floating-point Gram-Schmidt, exact GSO only as a fallback
+BABAI_FLOAT = True
+
+# number of reduced bases kept by reduction() / Smith forms by smith_form()
+LLL_CACHE_SIZE = 64
+SMITH_CACHE_SIZE = 16
+
+SAGE_NAMES = (
+    'next_prime', 'matrix', 'vector', 'inverse_mod', 'is_prime',
+    'identity_matrix', 'Integers', 'ZZ', 'RR', 'RealField',
+    )
+
+def load_sage():
+    '''
+    Imports the Sage names this module uses into its globals. Importing Sage
+    takes seconds, so this only happens once something needs it.
+    '''
+    if 'matrix' not in globals():
+        import sage.all
+        globals().update((name, getattr(sage.all, name)) for name in SAGE_NAMES)
+
+def _installed(module):
+    try:
+        from importlib.util import find_spec
+    except ImportError:  # Python 2
+        import imp
+        try:
+            imp.find_module(module)
+            return True
+        except ImportError:
+            return False
+    return find_spec(module) is not None
+
+_active = []
+
+def backend_name(backend=None):
+    '''
+    The backend to use: the explicit argument, else the one of the call we
+    are nested in, else $LLL_BACKEND or BACKEND, else sage if installed.
+    '''
+    name = (backend or (_active and _active[-1])
+            or os.environ.get('LLL_BACKEND') or BACKEND)
+    if not name:
+        name = 'sage' if _installed('sage') else 'fpylll'
+    assert name in BACKENDS, 'unknown backend %r' % name
+    return name
+
+def dispatch(f):
+    '''
+    Runs f (the Sage implementation) or the function of the same name in
+    the selected backend module, see backend_name. Calls made from within
+    stay on the same backend.
+    '''
+    @functools.wraps(f)
+    def wrapper(*args, **kw):
+        name = backend_name(kw.pop('backend', None))
+        if BACKENDS[name] is None:
+            load_sage()
+            impl = f
+        else:
+            impl = getattr(importlib.import_module(BACKENDS[name]), f.__name__)
+        _active.append(name)
+        try:
+            return impl(*args, **kw)
+        finally:
+            _active.pop()
+    return wrapper
+
+class PhaseTimer(object):
+    '''
+    Wall time per phase (see phase()). Time spent in a nested phase only
+    counts for the inner one.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+        self.last = None
+
+    def _switch(self):
+        now = time.time()
+        if self.stack:
+            name = self.stack[-1]
+            self.times[name] = self.times.get(name, 0) + now - self.last
+        self.last = now
+
+    def enter(self, name):
+        self._switch()
+        self.stack.append(name)
+
+    def leave(self):
+        self._switch()
+        self.stack.pop()
+
+# set by benchmark() while it measures
+_timer = None
+
+@contextmanager
+def phase(name):
+    ''' Attributes the time of the block to `name` in the active PhaseTimer. '''
+    timer = _timer
+    if timer is None:
+        yield
+        return
+    timer.enter(name)
+    try:
+        yield
+    finally:
+        timer.leave()
 
 if FAST:
     ALGOS = ('fpLLL:wrapper',)
@@ -18,47 +146,244 @@ else:
     ALGOS = ('NTL:LLL', 'fpLLL:wrapper')
     DELTAS =(0.75, 0.9, 0.99, 0.999)
 
+class Reduction(object):
+    ''' A reduced basis plus its Gram-Schmidt data, computed on first use. '''
+    def __init__(self, B):
+        B.set_immutable()
+        self.B = B
+        self._gso = None
+        self._fgso = {}
+
+    def gram_schmidt(self):
+        if self._gso is None:
+            self._gso = self.B.gram_schmidt()
+        return self._gso
+
+    def float_gram_schmidt(self, prec):
+        '''
+        Gram-Schmidt vectors and their squared norms in RealField(prec), one
+        per row of B (zero rows of B give zero vectors). Cached per precision.
+        '''
+        if prec not in self._fgso:
+            F = RealField(prec)
+            G, norms = [], []
+            for row in self.B.rows():
+                g = vector(F, row)
+                for h, n in zip(G, norms):
+                    if n:
+                        g -= (g * h / n) * h
+                G.append(g)
+                norms.append(g * g)
+            self._fgso[prec] = G, norms
+        return self._fgso[prec]
+
+class LRU(object):
+    ''' Dict keeping only the `size` most recently used entries. '''
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.pop(key, None)
+        if value is not None:
+            self.data[key] = value
+        return value
+
+    def put(self, key, value):
+        self.data.pop(key, None)
+        while len(self.data) >= self.size:
+            self.data.popitem(last=False)
+        self.data[key] = value
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+_lll_cache = LRU(LLL_CACHE_SIZE)
+_smith_cache = LRU(SMITH_CACHE_SIZE)
+
+def basis_key(L):
+    ''' Canonical hash of a basis (dimensions and entries). '''
+    data = '%d %d %s' % (L.nrows(), L.ncols(), ' '.join(map(str, L.list())))
+    return hashlib.sha256(data.encode('ascii')).hexdigest()
+
+def _run_lll(L, algo, delta):
+    with phase('lll'):
+        if algo is None:
+            return L.LLL(delta=delta)
+        return L.LLL(algorithm=algo, delta=delta)
+
+def _cached(key):
+    return _lll_cache.get(key)
+
+def _store(key, B):
+    return _lll_cache.put(key, Reduction(B))
+
+def reduction(L, algo=None, delta=0.99):
+    '''
+    LLL-reduces L, reusing an earlier result for the same basis, algorithm
+    and delta. The LLL_CACHE_SIZE most recently used results are kept.
+    '''
+    key = (basis_key(L), algo, delta)
+    return _cached(key) or _store(key, _run_lll(L, algo, delta))
+
+def smith_form(A):
+    ''' A.smith_form(), reusing the result for a matrix seen before. '''
+    key = basis_key(A)
+    res = _smith_cache.get(key)
+    if res is None:
+        with phase('smith'):
+            res = A.smith_form()
+        for M in res:
+            M.set_immutable()
+        res = _smith_cache.put(key, res)
+    return res
+
+def clear_lll_cache():
+    _lll_cache.clear()
+    _smith_cache.clear()
+
 def lll_params():
     for algo in ALGOS:
         for delta in DELTAS:
-            yield (algo, delta, lambda x: x.LLL(algorithm=algo, delta=delta))
+            yield (algo, delta,
+                   lambda x, algo=algo, delta=delta: reduction(x, algo, delta).B)
+
+def _lll_job(args):
+    L, algo, delta = args
+    return algo, delta, _run_lll(L, algo, delta)
+
+def reductions(L):
+    '''
+    Yields (algo, delta, Reduction) for every parameter set of lll_params.
+    Cached ones come first. With PARALLEL, the rest are reduced concurrently
+    in a process pool and yielded as they finish; stopping the iteration
+    early terminates the reductions still running.
+    '''
+    h = basis_key(L)
+    todo = []
+    for algo, delta, _ in lll_params():
+        res = _cached((h, algo, delta))
+        if res is None:
+            todo.append((algo, delta))
+        else:
+            yield algo, delta, res
+
+    if not PARALLEL or len(todo) < 2:
+        for algo, delta in todo:
+            yield algo, delta, reduction(L, algo, delta)
+        return
+
+    pool = Pool(min(len(todo), cpu_count()))
+    try:
+        jobs = [(L, algo, delta) for algo, delta in todo]
+        for algo, delta, B in pool.imap_unordered(_lll_job, jobs):
+            yield algo, delta, _store((h, algo, delta), B)
+    finally:
+        pool.terminate()
+
+def bkz_reductions(L, block_sizes=BKZ_BLOCK_SIZES, budget=BKZ_TIME_BUDGET):
+    '''
+    Yields (block_size, Reduction) for BKZ reductions of L with growing block
+    sizes, until `budget` seconds have been spent. L must be a basis (no
+    zero rows). Results are cached like LLL reductions.
+    '''
+    h = basis_key(L)
+    start = time.time()
+    for k in block_sizes:
+        k = min(k, L.nrows())
+        left = budget - (time.time() - start)
+        if left <= 0:
+            return
+        key = (h, 'BKZ', k)
+        res = _cached(key)
+        if res is None:
+            with phase('lll'):
+                B = L.BKZ(block_size=k, max_time=left)
+            res = _store(key, B)
+        yield k, res
+        if k == L.nrows():
+            return
 
 def lll(L):
-    for algo, delta, f in lll_params():
-        for row in f(L).rows():
+    for _, _, red in reductions(L):
+        for row in red.B.rows():
             yield row
 
 def normalize(x):
     return x if next(c for c in x if c != 0) >= 0 else -x
 
-def svp(L):
-    res = None
-    for x in lll(L):
+def shortest_row(B, res=None):
+    for x in B.rows():
         if x == 0: continue
         if res is None or x.norm() < res.norm():
             res = x
-    return normalize(res)
+    return res
+
+@dispatch
+def svp(L, bound=None, check=None):
+    '''
+    Shortest nonzero row over all reductions of L. If `bound` is given, stops
+    at the first reduction that yields a vector with norm <= bound.
+
+    If the result fails `check` (default: the bound, if any), L is reduced
+    with BKZ at growing block sizes until some result passes.
+    '''
+    res = None
+    for _, _, red in reductions(L):
+        res = shortest_row(red.B, res)
+        if bound is not None and res is not None and res.norm() <= bound:
+            break
+    res = normalize(res)
+
+    check = check or (bound is not None and (lambda x: x.norm() <= bound))
+    if not check or check(res):
+        return res
+    for k, red in bkz_reductions(L):
+        x = normalize(shortest_row(red.B))
+        if check(x):
+            print('svp: BKZ with block size %d succeeded' % k)
+            return x
+    return res
 
 def integer_lgs(A, b, smith=None):
+    '''
+    Integer solution y of Ay = b. If b is a matrix, its columns are solved
+    for all at once and the solutions are returned as columns of a matrix.
+    '''
     # https://groups.google.com/forum/#!topic/sage-support/mSEvNtJlvgs
+    load_sage()
     if not smith:
-        smith = A.smith_form()
+        smith = smith_form(A)
     D, U, V = smith
     # assert D == U*A*V
     c = U * b
     d = D.diagonal()
-    y = vector(ZZ, D.ncols())
+    if not hasattr(b, 'ncols'):
+        y = vector(ZZ, D.ncols())
+        for i in range(len(d), D.nrows()):
+            assert not c[i], 'no integers solution'
+        for i in range(len(d)):
+            if d[i] == 0:
+                assert not c[i], 'no integer solution'
+                y[i] = 0
+            else:
+                q = c[i] / d[i]
+                assert q in ZZ, 'no integer solution'
+                y[i] = q
+        # assert D*y == c
+        return V * y
+
+    y = matrix(ZZ, D.ncols(), c.ncols())
     for i in range(len(d), D.nrows()):
-        assert not c[i], 'no integers solution'
+        assert c.row(i) == 0, 'no integers solution'
     for i in range(len(d)):
         if d[i] == 0:
-            assert not c[i], 'no integer solution'
-            y[i] = 0
+            assert c.row(i) == 0, 'no integer solution'
         else:
-            q = c[i] / d[i]
-            assert q in ZZ, 'no integer solution'
-            y[i] = q
-    # assert D*y == c
+            row = c.row(i)
+            assert all(x % d[i] == 0 for x in row), 'no integer solution'
+            y.set_row(i, row / d[i])
     return V * y
 
 def in_lattice(L, x):
@@ -68,61 +393,135 @@ def in_lattice(L, x):
     except AssertionError:
         return False
 
-def cvp_embed(L, v, b=None):
+def cvp_embed(L, v, b=None, bound=None):
     if not b:
         b = max(max(row) for row in L.rows())
 
     L2 = matrix([list(row) + [0] for row in L] + [list(v) + [b]])
     res = None
-    for x in lll(matrix(L2)):
-        if x[-1] > 0: x = -x
-        if x[-1] == -b:
-            u = vector(x[:-1]) + v
-            assert in_lattice(L, u)
-            if res is None or (v - u).norm() < (v - res).norm():
-                res = u
+    for _, _, red in reductions(matrix(L2)):
+        for x in red.B.rows():
+            if x[-1] > 0: x = -x
+            if x[-1] == -b:
+                u = vector(x[:-1]) + v
+                assert in_lattice(L, u)
+                if res is None or (v - u).norm() < (v - res).norm():
+                    res = u
+        if bound is not None and res is not None and (v - res).norm() <= bound:
+            break
     return res
 
-def cvp_babai(L, v):
+def babai_precision(B, v):
+    ''' Bits of precision for a floating-point GSO of B, from the entry sizes. '''
+    bits = max(abs(x) for x in B.list() + list(v)).nbits()
+    return max(53, 2*bits + 2*B.nrows().bit_length() + 20)
+
+def babai_float(red, v, prec):
+    '''
+    Nearest plane with floating-point GSO. Returns the remainder b = v - u for
+    the lattice vector u found, or None if b violates the nearest-plane bound
+    |b|^2 <= sum |G_i|^2 / 4, i.e. the precision was not enough.
+    '''
+    B = red.B
+    G, norms = red.float_gram_schmidt(prec)
+    F = RealField(prec)
+    b = v
+    for i in reversed(range(len(G))):
+        if not norms[i]:
+            continue
+        c = ZZ((vector(F, b) * G[i] / norms[i]).round())
+        b -= B[i]*c
+    if 4 * F(b * b) > sum(norms) * (1 + F(2)**-20):
+        return None
+    return b
+
+def babai_exact(red, v):
+    B = red.B
+    G,_ = red.gram_schmidt()
+    b = v
+    for i in reversed(range(G.nrows())):
+        c = ((b * G[i]) / (G[i] * G[i])).round()
+        b -= B[i]*c
+    return b
+
+def cvp_babai(L, v, bound=None):
+    '''
+    Babai's nearest plane over every reduction of L. With BABAI_FLOAT the GSO
+    is done in floating point (see babai_precision); the exact rational GSO
+    is only computed if that result fails verification or misses `bound`.
+    '''
     # https://cims.nyu.edu/~regev/teaching/lattices_fall_2004/ln/cvp.pdf
     # http://mslc.ctf.su/wp/plaidctf-2016-sexec-crypto-300/
     res = None
-    for _, _, f in lll_params():
-        B = f(L)
-        G,_ = B.gram_schmidt()
-        b = v
-        for i in reversed(range(G.nrows())):
-            c = ((b * G[i]) / (G[i] * G[i])).round()
-            b -= B[i]*c
+    for _, _, red in reductions(L):
+        b = None
+        if BABAI_FLOAT:
+            b = babai_float(red, v, babai_precision(red.B, v))
+            if b is not None and bound is not None and b.norm() > bound:
+                b = None
+        if b is None:
+            b = babai_exact(red, v)
         if res is None or (v - b).norm() < res.norm():
             res = v - b
+        if bound is not None and (v - res).norm() <= bound:
+            break
     return res
 
-def cvp(L, v):
-    res = cvp_embed(L, v)
-    res2 = cvp_babai(L, v)
-    if res is None or (res2 - v).norm() < (res - v).norm():
-        res = res2
+@dispatch
+def cvp(L, v, bound=None, check=None):
+    '''
+    Lattice vector close to v. With a `bound` on the distance, stops as soon
+    as some reduction gives a vector within it.
+
+    If the result fails `check` (default: the bound, if any), Babai is rerun
+    on BKZ reductions of L with growing block sizes.
+    '''
+    res = cvp_embed(L, v, bound=bound)
+    if bound is None or res is None or (res - v).norm() > bound:
+        res2 = cvp_babai(L, v, bound=bound)
+        if res is None or (res2 - v).norm() < (res - v).norm():
+            res = res2
+
+    check = check or (bound is not None and (lambda u: (u - v).norm() <= bound))
+    if not check or check(res):
+        return res
+    for k, red in bkz_reductions(L):
+        b = None
+        if BABAI_FLOAT:
+            b = babai_float(red, v, babai_precision(red.B, v))
+        if b is None:
+            b = babai_exact(red, v)
+        if check(v - b):
+            print('cvp: BKZ with block size %d succeeded' % k)
+            return v - b
     return res
 
 def mod_right_kernel(A, mod):
-    # from https://ask.sagemath.org/question/33890/how-to-find-kernel-of-a-matrix-in-mathbbzn/
-    # too slow though
-    Zn = ZZ**A.ncols()
-    M = Zn/(mod*Zn)
-    phi = M.hom([M(a) for a in A] + [M(0) for _ in range(A.ncols()-A.nrows())])
-    return matrix([M(b) for b in phi.kernel().gens()])
+    '''
+    Square basis of the lattice of x in Z^n with Ax = 0 (mod m), for any m.
+
+    x is in the lattice iff (x, y) is in the integer kernel of [A | -m*I] for
+    some y. Projecting that kernel onto x is injective (m*y = 0 forces y = 0),
+    so the first n columns of its echelonized (Hermite form) basis are an
+    n x n basis. Everything happens over ZZ, so composite m is no problem.
+    '''
+    load_sage()
+    A = matrix(ZZ, [[a % mod for a in row] for row in A])
+    m, n = A.dimensions()
+    with phase('kernel'):
+        K = A.augment(-mod * identity_matrix(ZZ, m)).right_kernel_matrix()
+    return K.matrix_from_columns(range(n))
 
 def kernel_lattice(A, mod=None):
     ''' Lattice of vectors x with Ax = 0 (potentially mod m) '''
-    A = matrix(ZZ if mod is None else Integers(mod), A)
-    L = [vector(ZZ, row) for row in A.right_kernel().basis()]
+    load_sage()
     if mod is not None:
-        cols = len(L[0])
-        for i in range(cols):
-            L.append([0]*i + [mod] + [0]*(cols-i-1))
-    return matrix(L)
+        return mod_right_kernel(A, mod)
+    A = matrix(ZZ, A)
+    with phase('kernel'):
+        return matrix([vector(ZZ, row) for row in A.right_kernel().basis()])
 
+@dispatch
 def small_lgs(A, c=None, mod=None):
     '''
     Find short x with Ax = c (mod m).
@@ -133,15 +532,22 @@ def small_lgs(A, c=None, mod=None):
     to produce a non-zero solution.
 
     From section 3.4 in [1]. This works by computing the lattice orthogonal to A,
-    i.e. the lattice of vectors x with Ax = 0. This is not easy modulo a composite.
+    i.e. the lattice of vectors x with Ax = 0. Modulo a composite, see
+    mod_right_kernel.
     '''
     A = matrix(ZZ, A)
     L = kernel_lattice(A, mod)
     if c == 0 or c is None:
         return svp(L)
-    y = integer_lgs(A, c)
+    if mod is None:
+        y = integer_lgs(A, c)
+    else:
+        # any y with Ay = c (mod m), from an integer solution of [A | m*I]
+        y = integer_lgs(A.augment(mod * identity_matrix(ZZ, A.nrows())),
+                        vector(ZZ, c))[:A.ncols()]
     return y - cvp(L, y)
 
+@dispatch
 def small_lgs2(A, c, mod, sol=None):
     '''
     Find short x with Ax = c (mod m).
@@ -160,7 +566,7 @@ def small_lgs2(A, c, mod, sol=None):
     for i in range(n):
         A.append([0]*i + [mod] + [0]*(n-i-1))
     A = matrix(ZZ, A)
-    L = A.LLL(delta=0.999999)
+    L = reduction(A, delta=0.999999).B
 
     for i in range(m):
         assert L[i] == 0
@@ -173,14 +579,22 @@ def small_lgs2(A, c, mod, sol=None):
             assert 0 <= x < mod
         return x
 
-    # compute Y such that Y*A == L
-    Y = []
-    smith = A.transpose().smith_form()
-    for i in range(L.nrows()):
-        y = integer_lgs(None, L[i], smith)
-        # assert At*y == L[i]
-        Y.append(y)
-    Y = matrix(ZZ, Y)
+    try:
+        return _small_lgs2_solve(A, L, c, mod, n)
+    except AssertionError:
+        # LLL was not strong enough, try BKZ
+        for k, red in bkz_reductions(L):
+            try:
+                x = _small_lgs2_solve(A, red.B, c, mod, n)
+            except AssertionError:
+                continue
+            print('small_lgs2: BKZ with block size %d succeeded' % k)
+            return x
+        raise
+
+def _small_lgs2_solve(A, L, c, mod, n):
+    # compute Y such that Y*A == L, i.e. At*Yt == Lt, all rows at once
+    Y = integer_lgs(A.transpose(), L.transpose()).transpose()
     # assert Y*A == L
 
     c = Y*vector(list(c)+[0]*n)%mod
@@ -190,6 +604,88 @@ def small_lgs2(A, c, mod, sol=None):
         assert abs(c[i]) * 2 < mod
     return integer_lgs(Y*A, c)
 
+class IncrementalLGS(object):
+    '''
+    Finds short x with Ax = c (mod m) like small_lgs2, with the equations
+    added one at a time.
+
+    Instead of the Smith form, every basis row l of the lattice spanned by
+    the equations and m*I carries its right-hand side l*x mod m. A new
+    equation is LLL-reduced together with the previous reduced basis, whose
+    values are mapped along with the LLL transformation. Once the basis is
+    short enough that |l*x| < m/2 for all rows, x is the solution of
+    Lx = centered values.
+
+    add() returns the solution as soon as it satisfies every equation and
+    `check` (if given). Without a check, it waits until two consecutive
+    equations give the same nonzero x; if the equations run out before that,
+    finish() returns the last candidate.
+    '''
+    def __init__(self, n, mod, check=None, delta=0.999999):
+        load_sage()
+        self.n = n
+        self.mod = mod
+        self.check = check
+        self.delta = delta
+        self.L = mod * identity_matrix(ZZ, n)
+        self.vals = vector(ZZ, n)
+        self.equations = []
+        self.candidate = None
+        self.solution = None
+
+    def add(self, a, c):
+        ''' Adds a*x = c (mod m). Returns the solution if it is determined. '''
+        a = vector(ZZ, a)
+        c = ZZ(c) % self.mod
+        self.equations.append((a, c))
+
+        M = matrix(ZZ, [a] + self.L.rows())
+        with phase('lll'):
+            B, U = M.LLL(delta=self.delta, transformation=True)
+        vals = U * vector(ZZ, [c] + list(self.vals))
+        rows, keep = [], []
+        for row, val in zip(B.rows(), vals):
+            if row == 0:
+                assert val % self.mod == 0, 'inconsistent equations'
+            else:
+                rows.append(row)
+                keep.append(val % self.mod)
+        self.L = matrix(ZZ, rows)
+        self.vals = vector(ZZ, keep)
+
+        x = self.solve()
+        if x is not None and self.check is None:
+            x, self.candidate = (x if x == self.candidate else None), x
+        self.solution = x
+        return x
+
+    def finish(self):
+        '''
+        The solution, or without a check the candidate from the last equation
+        if it satisfies all of them but has not been confirmed by another
+        one. None if there is neither.
+        '''
+        if self.solution is not None or self.check is not None:
+            return self.solution
+        return self.candidate
+
+    def solve(self):
+        t = vector(ZZ, [v - self.mod if 2*v >= self.mod else v
+                        for v in self.vals])
+        x = self.L.solve_right(t)
+        if any(xi not in ZZ for xi in x):
+            return None
+        x = vector(ZZ, x)
+        if x == 0 or not self.verify(x):
+            return None
+        return x
+
+    def verify(self, x):
+        if any((a*x - c) % self.mod for a, c in self.equations):
+            return False
+        return self.check is None or self.check(x)
+
+@dispatch
 def truncated_lgs(A, y, mod):
     '''
     Find short x with A(y + x) = 0 (mod m).
@@ -208,27 +704,219 @@ def truncated_lgs(A, y, mod):
     for i in range(n):
         A.append([0]*i + [mod] + [0]*(n-i-1))
 
-    L = matrix(ZZ, A).LLL()
+    L = reduction(matrix(ZZ, A)).B
     W1 = L*vector(ZZ, y)
     W2 = vector([int(round(RR(w)/mod))*mod - w for w in W1])
     return L.solve_right(W2) + y
 
 
+# benchmark(): the grid of random instances and the measured phases
+PROBLEMS = ('small_lgs', 'small_lgs2', 'truncated_lgs')
+DIMENSIONS = (10, 20, 30, 40)
+MODULI = (
+    2**127 - 1,                                 # prime
+    21652247421304131782679331804390761485569,  # composite, see README.md
+    )
+ENTRY_BITS = (16, 32, 64)
+PHASES = ('kernel', 'lll', 'smith', 'solve')
+
+def _inverse(a, mod):
+    ''' a^-1 mod m, or None if a is not invertible. '''
+    r0, r1, s0, s1 = a % mod, mod, 1, 0
+    while r1:
+        q = r0 // r1
+        r0, r1, s0, s1 = r1, r0 - q*r1, s1, s0 - q*s1
+    return s0 % mod if r0 == 1 else None
+
+def _dot(x, y):
+    return sum(a*b for a, b in zip(x, y))
+
+def random_instance(problem, n, mod, bits, rng, equations=None):
+    '''
+    (A, b, solution) for `problem` with n unknowns and n-1 (or `equations`)
+    random equations mod m, as plain integer lists:
+
+    - small_lgs, small_lgs2: b = Ax (mod m) for random x of `bits` bits
+    - truncated_lgs: b = y, the secret s with Ax = 0 (mod m) with its lowest
+      `bits` bits cleared; the solution is s
+    '''
+    m = equations or n - 1
+    A = [[rng.randrange(mod) for _ in range(n)] for _ in range(m)]
+    if problem == 'truncated_lgs':
+        s = [rng.randrange(mod) for _ in range(n)]
+        inv = _inverse(s[-1], mod)
+        while inv is None:
+            s[-1] = rng.randrange(mod)
+            inv = _inverse(s[-1], mod)
+        for row in A:
+            row[-1] = -_dot(row[:-1], s[:-1]) * inv % mod
+        return A, [v >> bits << bits for v in s], s
+    x = [rng.randrange(2**bits) for _ in range(n)]
+    return A, [_dot(row, x) % mod for row in A], x
+
+def _solved(problem, A, b, mod, solution, res):
+    res = [int(v) for v in res]
+    if problem == 'small_lgs':
+        # any solution at most as long as the planted one will do
+        return (all((_dot(row, res) - c) % mod == 0 for row, c in zip(A, b))
+                and _dot(res, res) <= _dot(solution, solution))
+    return res == solution
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _instance_seed(*key):
+    data = ' '.join(map(str, key)).encode('ascii')
+    return int(hashlib.sha256(data).hexdigest(), 16)
+
+def bench_cell(problem, n, mod, bits, runs=5, seed=0, backend=None):
+    '''
+    Solves `runs` random instances of one grid cell and returns its success
+    rate, mean wall time per phase and the peak RSS of the process. Every
+    instance is seeded from (seed, cell, run), so a cell can be rerun alone.
+    '''
+    global _timer
+    backend = backend_name(backend)
+    _reset_peak_rss()
+    times = dict((name, 0.0) for name in PHASES)
+    total, successes, errors = 0.0, 0, []
+    for run in range(runs):
+        rng = Random(_instance_seed(seed, problem, n, mod, bits, run))
+        A, b, solution = random_instance(problem, n, mod, bits, rng)
+        A2, b2 = A, b
+        if BACKENDS[backend] is None:
+            load_sage()
+            A2, b2 = matrix(ZZ, A), vector(ZZ, b)
+
+        _timer = PhaseTimer()
+        start = time.time()
+        try:
+            with phase('solve'):
+                res = globals()[problem](A2, b2, mod, backend=backend)
+            successes += _solved(problem, A, b, mod, solution, res)
+        except Exception as e:
+            errors.append('%s: %s' % (type(e).__name__, e))
+        finally:
+            total += time.time() - start
+            for name, t in _timer.times.items():
+                times[name] += t
+            _timer = None
+
+    return OrderedDict([
+        ('problem', problem),
+        ('backend', backend),
+        ('n', n),
+        ('equations', n - 1),
+        ('mod', mod),
+        ('bits', bits),
+        ('runs', runs),
+        ('successes', successes),
+        ('success_rate', float(successes) / runs),
+        ('time', total / runs),
+        ('phases', OrderedDict((name, times[name] / runs) for name in PHASES)),
+        ('peak_rss_kb', _peak_rss_kb()),
+        ('errors', sorted(set(errors))),
+    ])
+
+def _bench_child(queue, args, kw):
+    try:
+        queue.put((True, bench_cell(*args, **kw)))
+    except BaseException as e:
+        queue.put((False, '%s: %s' % (type(e).__name__, e)))
+
+def _isolated_bench_cell(*args, **kw):
+    ''' bench_cell in a fresh child process, so the peak RSS is its own. '''
+    queue = Queue()
+    child = Process(target=_bench_child, args=(queue, args, kw))
+    child.start()
+    try:
+        while True:
+            try:
+                ok, res = queue.get(timeout=1)
+                break
+            except Empty:
+                if not child.is_alive():
+                    try:
+                        ok, res = queue.get_nowait()
+                        break
+                    except Empty:
+                        raise RuntimeError('benchmark process died with %s'
+                                           % child.exitcode)
+    finally:
+        child.join()
+    if not ok:
+        raise RuntimeError(res)
+    return res
+
+def benchmark(problems=PROBLEMS, dimensions=DIMENSIONS, moduli=MODULI,
+              entry_bits=ENTRY_BITS, runs=5, seed=0, backend=None,
+              isolate=True):
+    '''
+    Runs bench_cell over the grid and returns a JSON-serializable report. With
+    `isolate`, each cell runs in its own process (see _isolated_bench_cell).
+    '''
+    backend = backend_name(backend)
+    run_cell = _isolated_bench_cell if isolate else bench_cell
+    results = []
+    for problem, n, mod, bits in product(problems, dimensions, moduli,
+                                         entry_bits):
+        res = run_cell(problem, n, mod, bits, runs=runs, seed=seed,
+                       backend=backend)
+        print('%-14s n=%-3d mod=%-42d bits=%-3d  %d/%d solved  %8.3fs  %s  '
+              '%d kB' % (
+                  problem, n, mod, bits, res['successes'], runs, res['time'],
+                  ' '.join('%s=%.3f' % kv for kv in res['phases'].items()),
+                  res['peak_rss_kb']))
+        sys.stdout.flush()
+        results.append(res)
+    return OrderedDict([
+        ('backend', backend),
+        ('seed', seed),
+        ('runs', runs),
+        ('results', results),
+    ])
+
+
 if __name__ == "__main__":
-    test = 0
-    while True:
-        print '  Testing heterogenous LGS mod composite'
-        # from secrets import key
-        # p = 2**126
-        # p = 2**135
-        p = 21652247421304131782679331804390761485569
-        assert not is_prime(p)
-        Zp = Integers(p)
-
-        n = 40 # num vars
-        m = n-1 # num equations
-
-        x = vector([randrange(lo) for _ in range(n)])
-        A = matrix([[randrange(lo) for _ in range(n)] for _ in range(m)])
-        c = vector(ZZ,matrix(Zp,A)*x)
-        assert x == small_lgs2(A, c, p)
+    import argparse
+    # the backends import lll, which is a different module than __main__
+    import lll
+    ints = lambda s: [int(x) for x in s.split(',')]
+    parser = argparse.ArgumentParser(
+        description='Benchmark small_lgs, small_lgs2 and truncated_lgs on '
+                    'random instances.')
+    parser.add_argument('--problems', type=lambda s: s.split(','),
+                        default=PROBLEMS)
+    parser.add_argument('--dimensions', type=ints, default=DIMENSIONS)
+    parser.add_argument('--moduli', type=ints, default=MODULI)
+    parser.add_argument('--bits', type=ints, default=ENTRY_BITS,
+                        help='size of the unknown entries')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', choices=sorted(BACKENDS))
+    parser.add_argument('--no-isolate', dest='isolate', action='store_false',
+                        help='run all cells in this process')
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    report = lll.benchmark(args.problems, args.dimensions, args.moduli, args.bits,
+                       args.runs, args.seed, args.backend, args.isolate)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
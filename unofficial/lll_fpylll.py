@@ -0,0 +1,390 @@
+'''
+Sage-free backend for lll.py: the same svp, cvp, small_lgs, small_lgs2 and
+truncated_lgs, on top of fpylll for the reductions and plain Python integers
+(and fractions) for everything else. Matrices and vectors may be anything
+iterable; results are lists of ints.
+
+Instead of Smith forms, integer linear algebra is done with lattice
+reduction as well:
+
+- kernels and particular solutions come from an echelon form mod m or an
+  embedding whose rows with a zero weighted part span exactly the wanted
+  lattice, see kernel_basis()
+- the right-hand sides of small_lgs2 are carried along the LLL
+  transformation, like lll.IncrementalLGS does
+'''
+from fractions import Fraction
+from math import gcd
+import time
+
+from fpylll import IntegerMatrix, LLL, BKZ, GSO, FPLLL
+
+from lll import BKZ_BLOCK_SIZES, BKZ_TIME_BUDGET, phase
+
+def to_rows(A):
+    return [[int(x) for x in row] for row in A]
+
+def from_fpylll(M):
+    return [[M[i, j] for j in range(M.ncols)] for i in range(M.nrows)]
+
+def nonzero(B):
+    return [row for row in B if any(row)]
+
+def dot(x, y):
+    return sum(a*b for a, b in zip(x, y))
+
+def norm2(x):
+    return dot(x, x)
+
+def sub(x, y):
+    return [a - b for a, b in zip(x, y)]
+
+def combine(coeffs, B):
+    ''' The linear combination sum c_i * B_i of the rows of B. '''
+    res = [0] * len(B[0])
+    for c, row in zip(coeffs, B):
+        if c:
+            res = [r + c*b for r, b in zip(res, row)]
+    return res
+
+def normalize(x):
+    return x if next(c for c in x if c != 0) >= 0 else [-c for c in x]
+
+def centered(v, mod):
+    v %= mod
+    return v - mod if 2*v >= mod else v
+
+def lll_reduce(B, delta=0.99, transform=False, name='lll'):
+    '''
+    LLL-reduced B (zero rows first), and the transformation if asked. The
+    time is charged to phase `name`.
+    '''
+    M = IntegerMatrix.from_matrix(B)
+    U = IntegerMatrix.identity(M.nrows) if transform else None
+    with phase(name):
+        LLL.reduction(M, U, delta=delta)
+    if not transform:
+        return from_fpylll(M)
+    return from_fpylll(M), from_fpylll(U)
+
+def bkz_reductions(B, block_sizes=BKZ_BLOCK_SIZES, budget=BKZ_TIME_BUDGET,
+                   transform=False):
+    '''
+    Yields (block_size, basis) or, with `transform`, (block_size, (basis,
+    transformation)) for BKZ reductions of B with growing block sizes, until
+    `budget` seconds have been spent. B must not have zero rows.
+    '''
+    start = time.time()
+    for k in block_sizes:
+        k = min(k, len(B))
+        left = budget - (time.time() - start)
+        if left <= 0:
+            return
+        M = IntegerMatrix.from_matrix(B)
+        U = IntegerMatrix.identity(M.nrows) if transform else None
+        with phase('lll'):
+            BKZ.reduction(M, BKZ.Param(block_size=k, max_time=left,
+                                       flags=BKZ.MAX_TIME), U=U)
+        yield k, ((from_fpylll(M), from_fpylll(U)) if transform
+                  else from_fpylll(M))
+        if k == len(B):
+            return
+
+def rank(A):
+    ''' Rank over Q, by Gaussian elimination. '''
+    A = [[Fraction(x) for x in row] for row in A]
+    r = 0
+    for j in range(len(A[0]) if A else 0):
+        p = next((i for i in range(r, len(A)) if A[i][j]), None)
+        if p is None:
+            continue
+        A[r], A[p] = A[p], A[r]
+        for i in range(r + 1, len(A)):
+            if A[i][j]:
+                f = A[i][j] / A[r][j]
+                A[i] = [a - f*b for a, b in zip(A[i], A[r])]
+        r += 1
+    return r
+
+def solve_right(L, t):
+    '''
+    The solution x of Lx = t over Q, for L with full column rank (extra
+    rows must be consistent). Entries are Fractions.
+    '''
+    n = len(L[0])
+    A = [[Fraction(x) for x in row] + [Fraction(b)] for row, b in zip(L, t)]
+    for j in range(n):
+        p = next(i for i in range(j, len(A)) if A[i][j])
+        A[j], A[p] = A[p], A[j]
+        piv = A[j][j]
+        A[j] = [a / piv for a in A[j]]
+        for i in range(len(A)):
+            if i != j and A[i][j]:
+                f = A[i][j]
+                A[i] = [a - f*b for a, b in zip(A[i], A[j])]
+    assert not any(row[-1] for row in A[n:]), 'no solution'
+    return [A[j][-1] for j in range(n)]
+
+def integer_solve(L, t):
+    x = solve_right(L, t)
+    assert all(xi.denominator == 1 for xi in x), 'no integer solution'
+    return [int(xi) for xi in x]
+
+def mod_kernel(gens, mod):
+    '''
+    Basis of the lattice of y with sum_j y_j*gens[j] = 0 (mod m), read off an
+    echelon form mod m: the pivot coordinates are determined by the free ones
+    up to multiples of m. None if that needs a pivot that is not a unit.
+    '''
+    d, k = len(gens), len(gens[0])
+    M = [[g[i] % mod for g in gens] for i in range(k)]
+    pivots = []
+    for j in range(d):
+        r = len(pivots)
+        p = next((i for i in range(r, k) if gcd(M[i][j], mod) == 1), None)
+        if p is None:
+            continue
+        M[r], M[p] = M[p], M[r]
+        inv = pow(M[r][j], -1, mod)
+        M[r] = [x * inv % mod for x in M[r]]
+        for i in range(k):
+            if i != r and M[i][j]:
+                f = M[i][j]
+                M[i] = [(a - f*b) % mod for a, b in zip(M[i], M[r])]
+        pivots.append(j)
+    if any(any(row) for row in M[len(pivots):]):
+        return None
+
+    basis = []
+    for j in range(d):
+        if j in pivots:
+            continue
+        row = [int(i == j) for i in range(d)]
+        for pj, eq in zip(pivots, M):
+            row[pj] = -eq[j] % mod
+        basis.append(row)
+    return basis + [[mod if i == pj else 0 for i in range(d)] for pj in pivots]
+
+def kernel_basis(A, mod=None, c=None):
+    '''
+    Basis of the lattice of x with Ax = 0 (mod m), or of (x, t) with
+    Ax = t*c (mod m) if c is given.
+
+    Modulo m, this comes from mod_kernel() unless it needs a pivot that is
+    not a unit. Otherwise it is the sublattice with zero second part of the
+    lattice spanned by (e_j, W*A*e_j), (0, W*m*e_i) and (0, -W*c) with an
+    extra coordinate t. If the weight W is large enough, LLL puts a basis of
+    that sublattice into its output. A subset of a basis whose size is the
+    rank of the sublattice spans all of it, so W is increased until the
+    count matches.
+    '''
+    A = to_rows(A)
+    k, n = len(A), len(A[0])
+    gens = [[A[i][j] for i in range(k)] for j in range(n)]
+    if c is not None:
+        gens.append([-int(ci) for ci in c])
+    d = len(gens)
+    if mod is not None:
+        with phase('kernel'):
+            K = mod_kernel(gens, mod)
+        if K is not None:
+            return K
+        gens = [[x % mod for x in g] for g in gens]
+        gens += [[mod if i == j else 0 for i in range(k)] for j in range(k)]
+        expected = d
+    else:
+        expected = d - rank(gens)
+
+    size = max([abs(x) for g in gens for x in g] + [1])
+    W = 2**(d // 2 + 1) * size
+    with phase('kernel'):
+        while True:
+            B = [[int(i == j) if j < d else 0 for i in range(d)]
+                 + [W*x for x in g] for j, g in enumerate(gens)]
+            # the reduction is how kernels are computed here, so it counts
+            # as kernel time rather than lll
+            K = [row[:d] for row in lll_reduce(B, name='kernel')
+                 if any(row[:d]) and not any(row[d:])]
+            if len(K) == expected:
+                return K
+            W *= 2**d
+
+def solution_and_kernel(A, c, mod=None):
+    '''
+    Some integer y with Ay = c (mod m) and a basis of the lattice of x with
+    Ax = 0 (mod m), both from the single reduction in kernel_basis(A, mod, c).
+    '''
+    K = kernel_basis(A, mod, c)
+    # the t coordinates of the basis generate the ideal of all t. Row
+    # operations Euclid-style leave one row with t != 0, which has to be
+    # t = +-1, and a basis of the t = 0 part, i.e. of the kernel, in the rest
+    while True:
+        nz = [r for r in K if r[-1]]
+        if len(nz) <= 1:
+            break
+        p = min(nz, key=lambda r: abs(r[-1]))
+        K = [r if r is p or not r[-1] else sub(r, [r[-1] // p[-1] * x for x in p])
+             for r in K]
+    assert nz and abs(nz[0][-1]) == 1, 'no integer solution'
+    row = nz[0]
+    return ([row[-1] * x for x in row[:-1]],
+            [r[:-1] for r in K if r is not row])
+
+def particular_solution(A, c, mod=None):
+    ''' Some integer y with Ay = c (mod m). '''
+    return solution_and_kernel(A, c, mod)[0]
+
+def shortest_row(B, res=None):
+    for x in nonzero(B):
+        if res is None or norm2(x) < norm2(res):
+            res = x
+    return res
+
+def svp(L, bound=None, check=None):
+    ''' See lll.svp. '''
+    B = lll_reduce(to_rows(L))
+    res = normalize(shortest_row(B))
+
+    check = check or (bound is not None and (lambda x: norm2(x) <= bound**2))
+    if not check or check(res):
+        return res
+    for k, B2 in bkz_reductions(nonzero(B)):
+        x = normalize(shortest_row(B2))
+        if check(x):
+            print('svp: BKZ with block size %d succeeded' % k)
+            return x
+    return res
+
+def cvp_embed(L, v, b=None):
+    if not b:
+        b = max(max(row) for row in L)
+    L2 = [row + [0] for row in L] + [v + [b]]
+    res = None
+    for x in lll_reduce(L2):
+        if x[-1] > 0:
+            x = [-xi for xi in x]
+        if x[-1] == -b:
+            # x = l - (v, b) for a lattice vector l
+            u = [xi + vi for xi, vi in zip(x[:-1], v)]
+            if res is None or norm2(sub(v, u)) < norm2(sub(v, res)):
+                res = u
+    return res
+
+def babai_precision(B, v):
+    bits = max(abs(x) for x in sum(B, []) + v).bit_length()
+    return max(53, 2*bits + 2*len(B).bit_length() + 20)
+
+def babai_float(B, v):
+    '''
+    Nearest plane with fpylll's MPFR Gram-Schmidt. None if the result
+    violates the nearest-plane bound, i.e. the precision was not enough.
+    '''
+    old = FPLLL.set_precision(babai_precision(B, v))
+    try:
+        G = GSO.Mat(IntegerMatrix.from_matrix(B), float_type='mpfr')
+        G.update_gso()
+        coeffs = G.babai(v)
+        norms = sum(G.get_r(i, i) for i in range(len(B)))
+    finally:
+        FPLLL.set_precision(old)
+    u = combine(coeffs, B)
+    if 4 * norm2(sub(v, u)) > norms * (1 + 2.0**-20):
+        return None
+    return u
+
+def babai_exact(B, v):
+    G = []
+    for row in B:
+        g = [Fraction(x) for x in row]
+        for h in G:
+            g = sub(g, [dot(g, h) / dot(h, h) * x for x in h])
+        G.append(g)
+    b = v
+    for i in reversed(range(len(B))):
+        c = round(dot(b, G[i]) / dot(G[i], G[i]))
+        b = sub(b, [c*x for x in B[i]])
+    return sub(v, b)
+
+def babai(B, v):
+    ''' Lattice vector close to v, B must be reduced and without zero rows. '''
+    return babai_float(B, v) or babai_exact(B, v)
+
+def cvp(L, v, bound=None, check=None):
+    ''' See lll.cvp. '''
+    L = to_rows(L)
+    v = [int(x) for x in v]
+    res = cvp_embed(L, v)
+    B = nonzero(lll_reduce(L))
+    res2 = babai(B, v)
+    if res is None or norm2(sub(res2, v)) < norm2(sub(res, v)):
+        res = res2
+
+    check = check or (bound is not None and
+                      (lambda u: norm2(sub(u, v)) <= bound**2))
+    if not check or check(res):
+        return res
+    for k, B2 in bkz_reductions(B):
+        u = babai(B2, v)
+        if check(u):
+            print('cvp: BKZ with block size %d succeeded' % k)
+            return u
+    return res
+
+def kernel_lattice(A, mod=None):
+    ''' Lattice of vectors x with Ax = 0 (potentially mod m) '''
+    return kernel_basis(A, mod)
+
+def small_lgs(A, c=None, mod=None):
+    ''' See lll.small_lgs. '''
+    if c is None or not any(c):
+        return svp(kernel_lattice(A, mod))
+    y, L = solution_and_kernel(A, c, mod)
+    return sub(y, cvp(L, y))
+
+def small_lgs2(A, c, mod, sol=None):
+    ''' See lll.small_lgs2. '''
+    A = to_rows(A)
+    m, n = len(A), len(A[0])
+    gens = A + [[mod if i == j else 0 for i in range(n)] for j in range(n)]
+    B, U = lll_reduce(gens, delta=0.999999, transform=True)
+    for i in range(m):
+        assert not any(B[i])
+    L, U = B[m:], U[m:]
+    if c is None or not any(c):
+        # same single-k heuristic as lll.small_lgs2
+        x = normalize(integer_solve(L, [0]*(n-1) + [mod]))
+        for t in x:
+            assert 0 <= t < mod
+        return x
+
+    # l*x = u*(c, 0) (mod m) for the rows l = u*gens of the reduced basis
+    vals = [dot(u, [int(ci) for ci in c] + [0]*n) for u in U]
+    try:
+        return _small_lgs2_solve(L, vals, mod)
+    except AssertionError:
+        # LLL was not strong enough, try BKZ
+        for k, (B2, U2) in bkz_reductions(L, transform=True):
+            try:
+                x = _small_lgs2_solve(B2, [dot(u, vals) for u in U2], mod)
+            except AssertionError:
+                continue
+            print('small_lgs2: BKZ with block size %d succeeded' % k)
+            return x
+        raise
+
+def _small_lgs2_solve(L, vals, mod):
+    t = [centered(v, mod) for v in vals]
+    for v in t:
+        assert abs(v) * 2 < mod
+    return integer_solve(L, t)
+
+def truncated_lgs(A, y, mod):
+    ''' See lll.truncated_lgs. '''
+    A = to_rows(A)
+    y = [int(x) for x in y]
+    n = len(A[0])
+    gens = A + [[mod if i == j else 0 for i in range(n)] for j in range(n)]
+    L = nonzero(lll_reduce(gens))
+    # nearest multiple of m to each l*y, exactly
+    W2 = [(2*w + mod) // (2*mod) * mod - w for w in (dot(l, y) for l in L)]
+    return [a + b for a, b in zip(integer_solve(L, W2), y)]
@@ -0,0 +1,123 @@
+'''
+Load generator for server.py: runs many client.py sessions concurrently
+and reports throughput, latency percentiles and errors.
+
+    python3 loadtest.py [--sessions N] [--concurrency C] [--mode correct|fail]
+                        [--host HOST] [--port PORT] [--output report.json]
+
+Every session speaks the same protocol as client.py: read the challenge
+line, send the response (the right one, or a random one in fail mode) and
+a newline. It then reads the verdict, which has to be ACCESS GRANTED
+(ACCESS DENIED in fail mode), and closes the connection.
+'''
+from collections import Counter, OrderedDict
+import argparse, asyncio, json, random, resource, time
+from secrets import key
+
+p = 21652247421304131782679331804390761485569
+N = 40
+TIMEOUT = 10
+
+class ProtocolError(Exception):
+    pass
+
+def response(chall, mode):
+    if mode == 'fail':
+        return random.randrange(p)
+    return sum(x*y%p for x, y in zip(chall, key))
+
+async def session(host, port, mode, timeout=TIMEOUT):
+    ''' One client.py session, returns its duration in seconds. '''
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+    try:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        chall = list(map(int, line.split()))
+        if len(chall) != N:
+            raise ProtocolError('bad challenge %r' % line[:40])
+        writer.write(str(response(chall, mode)).encode('utf-8') + b'\n')
+        verdict = await asyncio.wait_for(reader.readline(), timeout)
+    finally:
+        writer.close()
+    expected = b'ACCESS DENIED' if mode == 'fail' else b'ACCESS GRANTED'
+    if verdict.strip() != expected:
+        raise ProtocolError('unexpected verdict %r' % verdict[:40])
+    return time.perf_counter() - start
+
+def percentile(values, q):
+    ''' Nearest-rank percentile of sorted values. '''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+async def run(host, port, sessions, concurrency, mode, timeout=TIMEOUT):
+    '''
+    Runs `sessions` sessions with at most `concurrency` at a time and
+    returns the report.
+    '''
+    latencies, errors = [], Counter()
+    todo = [sessions]
+
+    async def worker():
+        while todo[0] > 0:
+            todo[0] -= 1
+            try:
+                latencies.append(await session(host, port, mode, timeout))
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError,
+                    ProtocolError) as e:
+                errors[type(e).__name__] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, sessions))))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return OrderedDict([
+        ('host', host),
+        ('port', port),
+        ('mode', mode),
+        ('sessions', sessions),
+        ('concurrency', concurrency),
+        ('ok', len(latencies)),
+        ('errors', dict(errors)),
+        ('elapsed', elapsed),
+        ('sessions_per_sec', len(latencies) / elapsed),
+        ('latency', OrderedDict(
+            [('p%g' % q, percentile(latencies, q)) for q in (50, 90, 99)]
+            + [('max', latencies[-1] if latencies else None)])),
+    ])
+
+def raise_fd_limit(wanted):
+    ''' Every session needs a socket, so lift the soft limit if we can. '''
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test server.py.')
+    parser.add_argument('--host', default='192.168.2.100')
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--mode', choices=('correct', 'fail'),
+                        default='correct')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--output', help='write the JSON report here')
+    args = parser.parse_args()
+
+    raise_fd_limit(args.concurrency + 64)
+    report = asyncio.run(run(args.host, args.port, args.sessions,
+                             args.concurrency, args.mode, args.timeout))
+    lat = report['latency']
+    print('%d/%d sessions ok in %.2fs: %.1f sessions/s, latency p50 %s '
+          'p90 %s p99 %s max %s, errors %s' % (
+              report['ok'], args.sessions, report['elapsed'],
+              report['sessions_per_sec'],
+              *('%.1fms' % (lat[k] * 1000) if lat[k] is not None else '-'
+                for k in ('p50', 'p90', 'p99', 'max')),
+              report['errors'] or 'none'))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,203 @@
+'''
+Index of the TCP sessions in a directory of captures.
+
+Captures are parsed by worker processes, one capture per task, and every
+session ends up as one row of an SQLite index: endpoints, timestamps, byte
+counts and a classification of the server's reply lines (see classify).
+Queries are answered from the index alone; captures are only parsed again
+if their size or mtime changed.
+
+    python pcapindex.py index captures/
+    python pcapindex.py query captures/ --port 1337 --kind GRANTED
+'''
+from __future__ import print_function
+from collections import namedtuple
+from multiprocessing import Pool, cpu_count
+import os, re, sqlite3
+
+from pcapstream import connections
+
+INDEX_NAME = 'sessions.sqlite'
+CAPTURE_EXTENSIONS = ('.pcap', '.pcapng', '.cap')
+
+# (kind, pattern) tried on the server's lines in order, first match wins
+CLASSES = (
+    ('GRANTED', re.compile(br'\bGRANTED\b')),
+    ('DENIED', re.compile(br'\bDENIED\b')),
+)
+# lines of the server data that classify() looks at
+CLASSIFY_LINES = 4
+# stored prefix of the first line of either side
+FIRST_LINE = 80
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    capture INTEGER NOT NULL REFERENCES captures(id),
+    client_host TEXT NOT NULL,
+    client_port INTEGER NOT NULL,
+    server_host TEXT NOT NULL,
+    server_port INTEGER NOT NULL,
+    start REAL,
+    end REAL,
+    client_bytes INTEGER NOT NULL,
+    server_bytes INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    client_line BLOB NOT NULL,
+    server_line BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_server
+    ON sessions (server_port, kind, server_host);
+CREATE INDEX IF NOT EXISTS sessions_capture ON sessions (capture);
+'''
+
+COLUMNS = ('client_host', 'client_port', 'server_host', 'server_port',
+           'start', 'end', 'client_bytes', 'server_bytes', 'kind',
+           'client_line', 'server_line')
+Session = namedtuple('Session', ('capture',) + COLUMNS)
+
+def first_line(data):
+    return data.split(b'\n', 1)[0][:FIRST_LINE]
+
+def classify(server):
+    '''
+    Kind of a session from the first CLASSIFY_LINES lines the server sent:
+    the first of CLASSES that matches, else 'empty' or 'other'.
+    '''
+    if not server:
+        return 'empty'
+    for line in server.split(b'\n', CLASSIFY_LINES)[:CLASSIFY_LINES]:
+        for kind, pattern in CLASSES:
+            if pattern.search(line):
+                return kind
+    return 'other'
+
+def captures(directory):
+    ''' Paths of the captures below `directory`, relative to it. '''
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.endswith(CAPTURE_EXTENSIONS):
+                yield os.path.relpath(os.path.join(root, name), directory)
+
+def _index_capture(args):
+    directory, path = args
+    rows = []
+    for conn in connections(os.path.join(directory, path)):
+        client, server = conn.client_data(), conn.server_data()
+        rows.append(conn.client + conn.server + (
+            conn.start, conn.end, len(client), len(server),
+            classify(server), first_line(client), first_line(server)))
+    return path, rows
+
+def open_index(directory, index=None):
+    db = sqlite3.connect(index or os.path.join(directory, INDEX_NAME))
+    db.executescript(SCHEMA)
+    return db
+
+def build_index(directory, index=None, workers=None):
+    '''
+    Indexes every new or changed capture below `directory`, spread over
+    `workers` processes (default: one per CPU). Returns the number of
+    captures that were (re)indexed.
+    '''
+    db = open_index(directory, index)
+    known = dict((path, (size, mtime)) for path, size, mtime in
+                 db.execute('SELECT path, size, mtime FROM captures'))
+    todo = []
+    for path in captures(directory):
+        st = os.stat(os.path.join(directory, path))
+        if known.get(path) != (st.st_size, st.st_mtime):
+            todo.append((path, st.st_size, st.st_mtime))
+    if not todo:
+        return 0
+
+    stats = dict((path, (size, mtime)) for path, size, mtime in todo)
+    pool = Pool(min(workers or cpu_count(), len(todo)))
+    try:
+        jobs = [(directory, path) for path, _, _ in todo]
+        for path, rows in pool.imap_unordered(_index_capture, jobs):
+            size, mtime = stats[path]
+            with db:
+                db.execute('DELETE FROM sessions WHERE capture IN '
+                           '(SELECT id FROM captures WHERE path = ?)', (path,))
+                db.execute('INSERT OR REPLACE INTO captures (path, size, mtime) '
+                           'VALUES (?, ?, ?)', (path, size, mtime))
+                capture, = db.execute('SELECT id FROM captures WHERE path = ?',
+                                      (path,)).fetchone()
+                db.executemany(
+                    'INSERT INTO sessions VALUES (%s)' % ', '.join(
+                        '?' * (len(COLUMNS) + 1)),
+                    [(capture,) + row[:-2] + tuple(map(sqlite3.Binary, row[-2:]))
+                     for row in rows])
+            print('%s: %d sessions' % (path, len(rows)))
+    finally:
+        pool.terminate()
+    db.close()
+    return len(todo)
+
+def query(directory, index=None, port=None, host=None, client=None,
+          kind=None, since=None, until=None):
+    '''
+    Yields the indexed sessions matching all given criteria (server port
+    and host, client host, kind, start time range) as Session tuples, with
+    the capture path in place of its id.
+    '''
+    where, args = [], []
+    for column, value in (('server_port', port), ('server_host', host),
+                          ('client_host', client), ('kind', kind)):
+        if value is not None:
+            where.append('%s = ?' % column)
+            args.append(value)
+    if since is not None:
+        where.append('start >= ?')
+        args.append(since)
+    if until is not None:
+        where.append('start < ?')
+        args.append(until)
+
+    db = open_index(directory, index)
+    try:
+        sql = ('SELECT captures.path, %s FROM sessions JOIN captures '
+               'ON captures.id = sessions.capture' % ', '.join(
+                   'sessions.' + c for c in COLUMNS))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY captures.path, start'
+        for row in db.execute(sql, args):
+            yield Session(*(row[:-2] + tuple(bytes(x) for x in row[-2:])))
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Index the TCP sessions of a directory of captures.')
+    parser.add_argument('command', choices=('index', 'query'))
+    parser.add_argument('directory')
+    parser.add_argument('--index', help='index file (default: %s in the '
+                        'capture directory)' % INDEX_NAME)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--port', type=int, help='server port')
+    parser.add_argument('--host', help='server host')
+    parser.add_argument('--client', help='client host')
+    parser.add_argument('--kind', help='one of %s, empty or other' % ', '.join(
+        kind for kind, _ in CLASSES))
+    parser.add_argument('--since', type=float, help='start timestamp')
+    parser.add_argument('--until', type=float, help='end timestamp')
+    args = parser.parse_args()
+
+    if args.command == 'index':
+        n = build_index(args.directory, args.index, args.workers)
+        print('%d captures indexed' % n)
+    else:
+        for s in query(args.directory, args.index, args.port, args.host,
+                       args.client, args.kind, args.since, args.until):
+            print('%s\t%s:%d\t%s:%d\t%.6f\t%d\t%d\t%s\t%r' % (
+                s.capture, s.client_host, s.client_port, s.server_host,
+                s.server_port, s.start or 0, s.client_bytes, s.server_bytes,
+                s.kind, s.server_line))
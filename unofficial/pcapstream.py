@@ -0,0 +1,326 @@
+'''
+Streaming TCP session reassembly for pcap and pcapng captures.
+
+The capture is read through a memory map and TCP connections are
+reassembled in memory, so nothing is written to disk and memory only grows
+with the connections open at the same time. Finished connections (both FINs
+or a RST, or idle for IDLE_TIMEOUT seconds of capture time) are yielded as
+soon as they are complete.
+
+    for client, server in streams('surveillance.pcap', port=1337):
+        ...
+'''
+from __future__ import print_function
+import mmap, socket, struct
+
+# seconds of capture time after which a silent connection counts as done
+IDLE_TIMEOUT = 600
+# how often (in packets) connections are checked for that
+IDLE_CHECK = 10000
+
+# link types
+NULL = 0
+ETHERNET = 1
+RAW = (12, 14, 101)
+LINUX_SLL = 113
+IPV4 = 228
+IPV6 = 229
+
+# TCP flags
+FIN = 0x01
+SYN = 0x02
+RST = 0x04
+ACK = 0x10
+
+def _pcap_packets(buf):
+    ''' (timestamp, linktype, frame) for every record of a classic pcap. '''
+    magic, = struct.unpack_from('<I', buf, 0)
+    order = '<' if magic in (0xa1b2c3d4, 0xa1b23c4d) else '>'
+    magic, = struct.unpack_from(order + 'I', buf, 0)
+    if magic == 0xa1b2c3d4:
+        unit = 1e-6
+    elif magic == 0xa1b23c4d:
+        unit = 1e-9
+    else:
+        raise ValueError('not a pcap file')
+    linktype, = struct.unpack_from(order + 'I', buf, 20)
+    linktype &= 0xffff
+    pos, end = 24, len(buf)
+    while pos + 16 <= end:
+        sec, frac, caplen, _ = struct.unpack_from(order + 'IIII', buf, pos)
+        pos += 16
+        yield sec + frac * unit, linktype, buf[pos:pos + caplen]
+        pos += caplen
+
+def _tsresol(buf, order, pos, end):
+    ''' Timestamp unit from the options of an interface description block. '''
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(order + 'HH', buf, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            v, = struct.unpack_from('B', buf, pos + 4)
+            return 2.0**-(v & 0x7f) if v & 0x80 else 10.0**-v
+        pos += 4 + (length + 3) // 4 * 4
+    return 1e-6
+
+def _pcapng_packets(buf):
+    ''' (timestamp, linktype, frame) for every packet block of a pcapng. '''
+    pos, end = 0, len(buf)
+    order = '<'
+    interfaces = []
+    while pos + 12 <= end:
+        btype, = struct.unpack_from(order + 'I', buf, pos)
+        if btype == 0x0a0d0d0a:
+            # section header, its byte order magic decides the rest
+            magic, = struct.unpack_from('<I', buf, pos + 8)
+            order = '<' if magic == 0x1a2b3c4d else '>'
+            interfaces = []
+        blen, = struct.unpack_from(order + 'I', buf, pos + 4)
+        if blen < 12:
+            raise ValueError('corrupt pcapng block at offset %d' % pos)
+
+        if btype == 1:
+            linktype, = struct.unpack_from(order + 'H', buf, pos + 8)
+            interfaces.append(
+                (linktype, _tsresol(buf, order, pos + 16, pos + blen - 4)))
+        elif btype == 6:
+            iface, hi, lo, caplen, _ = struct.unpack_from(
+                order + 'IIIII', buf, pos + 8)
+            linktype, unit = interfaces[iface]
+            yield (((hi << 32) | lo) * unit, linktype,
+                   buf[pos + 28:pos + 28 + caplen])
+        elif btype == 2:
+            # obsolete packet block
+            iface, _, hi, lo, caplen, _ = struct.unpack_from(
+                order + 'HHIIII', buf, pos + 8)
+            linktype, unit = interfaces[iface]
+            yield (((hi << 32) | lo) * unit, linktype,
+                   buf[pos + 28:pos + 28 + caplen])
+        elif btype == 3:
+            # simple packet block, no timestamp
+            origlen, = struct.unpack_from(order + 'I', buf, pos + 8)
+            caplen = min(origlen, blen - 16)
+            yield None, interfaces[0][0], buf[pos + 12:pos + 12 + caplen]
+        pos += blen
+
+def packets(path):
+    ''' (timestamp, linktype, frame) for every packet in a pcap or pcapng. '''
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+    try:
+        magic, = struct.unpack_from('<I', buf, 0)
+        if magic == 0x0a0d0d0a:
+            reader = _pcapng_packets(buf)
+        else:
+            reader = _pcap_packets(buf)
+        for packet in reader:
+            yield packet
+    finally:
+        buf.close()
+
+def _ip(linktype, frame):
+    ''' (version, header offset) of the IP packet in a link-layer frame. '''
+    if linktype == ETHERNET:
+        pos = 12
+        ethertype, = struct.unpack_from('!H', frame, pos)
+        while ethertype in (0x8100, 0x88a8):
+            # VLAN tags
+            pos += 4
+            ethertype, = struct.unpack_from('!H', frame, pos)
+        version = {0x0800: 4, 0x86dd: 6}.get(ethertype)
+        return version, pos + 2
+    if linktype == LINUX_SLL:
+        ethertype, = struct.unpack_from('!H', frame, 14)
+        return {0x0800: 4, 0x86dd: 6}.get(ethertype), 16
+    if linktype == NULL:
+        family, = struct.unpack_from('=I', frame, 0)
+        return (4 if family == 2 else 6 if family in (10, 24, 28, 30)
+                else None), 4
+    if linktype in RAW or linktype in (IPV4, IPV6):
+        v, = struct.unpack_from('B', frame, 0)
+        return v >> 4, 0
+    return None, 0
+
+def tcp_segments(path):
+    '''
+    (timestamp, (src, sport), (dst, dport), seq, flags, payload) for every
+    TCP segment in the capture. Non-first IPv4 fragments and IPv6 extension
+    headers are skipped.
+    '''
+    for ts, linktype, frame in packets(path):
+        try:
+            version, pos = _ip(linktype, frame)
+            if version == 4:
+                vihl, length, frag, proto = struct.unpack_from(
+                    '!BxHxxHxB', frame, pos)
+                if proto != 6 or frag & 0x3fff:
+                    continue
+                src = socket.inet_ntoa(frame[pos + 12:pos + 16])
+                dst = socket.inet_ntoa(frame[pos + 16:pos + 20])
+                end = pos + length
+                pos += (vihl & 0xf) * 4
+            elif version == 6:
+                length, proto = struct.unpack_from('!HB', frame, pos + 4)
+                if proto != 6:
+                    continue
+                src = socket.inet_ntop(socket.AF_INET6, frame[pos + 8:pos + 24])
+                dst = socket.inet_ntop(socket.AF_INET6,
+                                       frame[pos + 24:pos + 40])
+                end = pos + 40 + length
+                pos += 40
+            else:
+                continue
+            sport, dport, seq, off, flags = struct.unpack_from(
+                '!HHIxxxxBB', frame, pos)
+        except struct.error:
+            # truncated packet
+            continue
+        payload = frame[pos + (off >> 4) * 4:end]
+        yield ts, (src, sport), (dst, dport), seq, flags, payload
+
+class _Stream(object):
+    ''' One direction of a connection, reassembled by sequence number. '''
+    def __init__(self):
+        self.base = None
+        self.next = 0
+        self.chunks = []
+        self.pending = {}
+        self.size = 0
+        self.fin = False
+
+    def add(self, seq, flags, data):
+        if flags & SYN:
+            if self.base is None:
+                self.base = (seq + 1) & 0xffffffff
+            return
+        if self.base is None:
+            self.base = seq
+        off = (seq - self.base) & 0xffffffff
+        if off >= 1 << 31:
+            # from before the start of the stream
+            return
+        if off > self.next:
+            if len(data) > len(self.pending.get(off, b'')):
+                self.pending[off] = data
+            return
+        self._append(off, data)
+        while self.pending:
+            off = min(self.pending)
+            if off > self.next:
+                break
+            self._append(off, self.pending.pop(off))
+
+    def _append(self, off, data):
+        data = data[self.next - off:]
+        if data:
+            self.chunks.append(data)
+            self.next += len(data)
+            self.size += len(data)
+
+    def data(self):
+        return b''.join(self.chunks)
+
+class Connection(object):
+    '''
+    A reassembled TCP connection. `client` and `server` are (host, port);
+    the client is the side that sent the SYN, or the one with the higher
+    port if the handshake is not in the capture.
+    '''
+    def __init__(self, client, server, ts):
+        self.client = client
+        self.server = server
+        self.start = ts
+        self.end = ts
+        self.up = _Stream()
+        self.down = _Stream()
+        self.reset = False
+
+    @property
+    def closed(self):
+        return self.reset or (self.up.fin and self.down.fin)
+
+    def add(self, ts, src, seq, flags, payload):
+        if ts is not None:
+            self.end = ts
+        stream = self.up if src == self.client else self.down
+        stream.add(seq, flags, payload)
+        if flags & FIN:
+            stream.fin = True
+        if flags & RST:
+            self.reset = True
+
+    def client_data(self):
+        return self.up.data()
+
+    def server_data(self):
+        return self.down.data()
+
+    @property
+    def client_bytes(self):
+        return self.up.size
+
+    @property
+    def server_bytes(self):
+        return self.down.size
+
+def connections(path, idle=IDLE_TIMEOUT):
+    '''
+    Yields every TCP connection in the capture as a Connection, as soon as
+    it is closed or has been idle for `idle` seconds; the rest at the end.
+    '''
+    conns = {}
+    now = None
+    for i, (ts, src, dst, seq, flags, payload) in enumerate(tcp_segments(path)):
+        if ts is not None:
+            now = ts
+        key = (src, dst) if src < dst else (dst, src)
+        conn = conns.get(key)
+        if conn is not None and flags & SYN and not flags & ACK and (
+                conn.closed or conn.up.size or conn.down.size):
+            # port reused for a new connection
+            yield conns.pop(key)
+            conn = None
+        if conn is None:
+            if not (flags & SYN or payload):
+                # stray ACK/FIN of a connection that is already done
+                continue
+            if flags & SYN:
+                client = dst if flags & ACK else src
+            else:
+                client = src if src[1] > dst[1] else dst
+            server = dst if client == src else src
+            conn = conns[key] = Connection(client, server, ts)
+        conn.add(ts, src, seq, flags, payload)
+        if conn.closed:
+            yield conns.pop(key)
+
+        if idle is not None and now is not None and i % IDLE_CHECK == 0:
+            for key in [k for k, c in conns.items()
+                        if c.end is not None and c.end < now - idle]:
+                yield conns.pop(key)
+
+    for conn in sorted(conns.values(), key=lambda c: c.start or 0):
+        yield conn
+
+def streams(path, host=None, port=None, idle=IDLE_TIMEOUT):
+    '''
+    Yields (client_bytes, server_bytes) for every TCP connection in the
+    capture, optionally only those to server `host` and/or `port`.
+    '''
+    for conn in connections(path, idle):
+        if host is not None and conn.server[0] != host:
+            continue
+        if port is not None and conn.server[1] != port:
+            continue
+        yield conn.client_data(), conn.server_data()
+
+if __name__ == '__main__':
+    import sys
+    for conn in connections(sys.argv[1]):
+        print('%s:%d -> %s:%d  %d/%d bytes' % (
+            conn.client + conn.server + (conn.client_bytes, conn.server_bytes)))
@@ -1,4 +1,4 @@
-import os, math, sys, binascii
+import os, math, sys, binascii, asyncio
 from secrets import key, flag
 from hashlib import sha256
 from Crypto.Cipher import AES
@@ -6,6 +6,7 @@ from Crypto.Cipher import AES
 p = 21652247421304131782679331804390761485569
 bits = 128
 N = 40
+TIMEOUT = 60
 
 def rand():
     return int.from_bytes(os.urandom(bits // 8), 'little')
@@ -13,18 +14,65 @@ def rand():
 def keygen():
     return [rand() for _ in range(N)]
 
+def encrypted_flag():
+    cipher = AES.new(
+            sha256(' '.join(map(str, key)).encode('utf-8')).digest(),
+            AES.MODE_CFB,
+            b'\0'*16)
+    return binascii.hexlify(cipher.encrypt(flag)).decode('utf-8')
+
+# x*y%p == x*(y%p)%p, so the key can be reduced once up front
+reduced_key = [y % p for y in key]
+
+def expected_response(challenge):
+    return sum(x*y%p for x, y in zip(challenge, reduced_key))
+
+async def handle(reader, writer, flagenc):
+    ''' Same dialogue as the stdin mode below, for one TCP client. '''
+    challenge = keygen()
+    writer.write((' '.join(map(str, challenge)) + '\n').encode('utf-8'))
+    try:
+        response = int(await asyncio.wait_for(reader.readline(), TIMEOUT))
+    except (asyncio.TimeoutError, ValueError):
+        writer.close()
+        return
+    if response != expected_response(challenge):
+        writer.write(b'ACCESS DENIED\n')
+    else:
+        writer.write(('ACCESS GRANTED\n%s\n' % flagenc).encode('utf-8'))
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+    writer.close()
+
+def serve(host, port):
+    # the key, IV and flag never change, so neither does the ciphertext
+    flagenc = encrypted_flag()
+
+    async def main():
+        server = await asyncio.start_server(
+                lambda r, w: handle(r, w, flagenc), host, port, backlog=4096)
+        print('Listening on %s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+    asyncio.run(main())
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        # python3 server.py serve [PORT [HOST]]
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 1337
+        host = sys.argv[3] if len(sys.argv) > 3 else '0.0.0.0'
+        serve(host, port)
+        exit(0)
+
     # key = keygen()   # generated once & stored in secrets.py
     challenge = keygen()
     print(' '.join(map(str, challenge)))
     response = int(input())
-    if response != sum(x*y%p for x, y in zip(challenge, key)):
+    if response != expected_response(challenge):
         print('ACCESS DENIED')
         exit(1)
 
     print('ACCESS GRANTED')
-    cipher = AES.new(
-            sha256(' '.join(map(str, key)).encode('utf-8')).digest(),
-            AES.MODE_CFB,
-            b'\0'*16)
-    print(binascii.hexlify(cipher.encrypt(flag)).decode('utf-8'))
+    print(encrypted_flag())
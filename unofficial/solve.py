@@ -1,42 +1,39 @@
-import pkappa
 import os, math, sys, binascii
 from hashlib import sha256
 from Crypto.Cipher import AES
-from lll import small_lgs2, vector, matrix, Integers, ZZ
+from lll import IncrementalLGS
+from pcapstream import streams
 from secrets import key
 
 N = 40
 p = 21652247421304131782679331804390761485569
-Zp = Integers(p)
 
-os.system('rm -rf ./tmp')
-pkappa.extract_pcap('surveillance.pcap', 'tmp')
-pcap = pkappa.PcapDir('tmp/192.168.2.100_1337')
+def decrypt(x, flagenc):
+    cipher = AES.new(
+            key=sha256(' '.join(map(str, x)).encode('utf-8')).digest(),
+            mode=AES.MODE_CFB,
+            IV=b'\0'*16)
+    return cipher.decrypt(flagenc)
 
-challs = []
-answers = []
+# stops reading sessions as soon as the key decrypts the flag
+flagenc = None
+solver = IncrementalLGS(N, p,
+        check=lambda x: decrypt(x, flagenc).startswith(b'35C3_'))
+x = None
 
-for s in pcap.all:
-    server = pcap.get_server_stream(s)
+for client, server in streams('surveillance.pcap', '192.168.2.100', 1337):
     if 'GRANTED' in server:
         chall = map(int, server.split('\n')[0].split())
         flagenc = server.split('\n')[2].decode('hex')
         assert len(chall) == N
-        resp = int(pcap.get_client_stream(s).strip())
-        challs.append(chall)
-        answers.append(resp)
+        resp = int(client.strip())
+        x = solver.add(chall, resp)
+        if x is not None:
+            print "Key recovered from %d sessions" % len(solver.equations)
+            break
     else:
-        print "Invalid", s
+        print "Invalid", repr(server[:40])
 
-assert len(challs) == N-1
-A = matrix(challs)
-c = vector(ZZ,answers)
-x = small_lgs2(A, c, p)
+assert x is not None
 assert list(x) == list(key)
-
-
-cipher = AES.new(
-        key=sha256(' '.join(map(str, x)).encode('utf-8')).digest(),
-        mode=AES.MODE_CFB,
-        IV=b'\0'*16)
-print(cipher.decrypt(flagenc))
+print(decrypt(x, flagenc))